@@ -0,0 +1,901 @@
+# Benchmarks for the racetrack pipeline, run without an Arduino attached.
+# Usage: python benchmarks.py [name ...]   (no names runs all of them)
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import asyncio
+import csv
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from bulk_upload import import_files
+from calibration import CalibrationRun, LevelEstimate
+from lanes import IDLE, Lane, LaneSession, run_race
+from lap_detector import LapDetector
+from leaderboard import Leaderboard
+from metrics import Metrics
+from race_engine import RaceEngine
+from race_result import RaceResult
+from sample_buffer import SampleRingBuffer
+from sensor_protocol import (
+    FRAME_SIZE,
+    IDLE_MODE,
+    RACE_MODE,
+    SAMPLES_PER_FRAME,
+    SampleReader,
+    encode_frame,
+    new_sample_arrays,
+)
+from simulator import SimulatedArduino
+from spectators import SpectatorServer
+from traces import TraceWriter, replay_race
+from uploader import Outbox, Uploader, make_row
+
+
+class LoopbackPort:
+    """In-memory stand-in for serial.Serial: everything written can be read back.
+
+    pyserial's own loop:// port queues single bytes (and blocks once 4 KB are
+    pending), which makes it the bottleneck of any throughput measurement.
+    Like a real port, readinto() waits up to `timeout` for the buffer to fill.
+    """
+
+    def __init__(self, timeout=0.1):
+        self.timeout = timeout
+        self._data = bytearray()
+        self._arrived = threading.Condition()
+
+    @property
+    def in_waiting(self):
+        return len(self._data)
+
+    def write(self, data):
+        with self._arrived:
+            self._data += data
+            self._arrived.notify_all()
+        return len(data)
+
+    def read(self, size=1):
+        data = bytes(self._data[:size])
+        del self._data[:size]
+        return data
+
+    def readinto(self, buffer):
+        with self._arrived:
+            self._arrived.wait_for(lambda: len(self._data) >= len(buffer), self.timeout)
+            size = min(len(buffer), len(self._data))
+            buffer[:size] = self._data[:size]
+            del self._data[:size]
+        return size
+
+    def readline(self):
+        end = self._data.find(b"\n") + 1 or len(self._data)
+        return self.read(end)
+
+    def reset_input_buffer(self):
+        self._data.clear()
+
+
+def bench_protocol(frames=20000):
+    """Decode throughput of binary frames versus ASCII lines over a loopback port."""
+    samples = [random.randint(0, 1023) for _ in range(SAMPLES_PER_FRAME)]
+    total = frames * SAMPLES_PER_FRAME
+
+    # Binary frames
+    port = LoopbackPort()
+    reader = SampleReader(port)
+    reader.binary = True
+    for sequence in range(frames):
+        port.write(encode_frame(sequence, sequence * 32 * 250, 250, samples))
+    times, values = new_sample_arrays()
+    start = time.perf_counter()
+    while len(values) < total:
+        reader.read_batch(times, values)
+    binary_rate = total / (time.perf_counter() - start)
+    assert reader.dropped_frames == 0 and reader.resyncs == 0
+
+    # A byte lost mid-stream costs only that frame, even with the magic in
+    # other frames' timestamps
+    port = LoopbackPort()
+    reader = SampleReader(port)
+    reader.binary = True
+    stream = bytearray(
+        b"".join(encode_frame(sequence, 0xA55A0000 + sequence * 8000, 250, samples) for sequence in range(100))
+    )
+    del stream[50 * FRAME_SIZE + 20]
+    port.write(bytes(stream))
+    corrupted_times, corrupted_values = new_sample_arrays()
+    while reader.read_batch(corrupted_times, corrupted_values):
+        pass
+    assert reader.frames == 99 and reader.dropped_frames == 1, (reader.frames, reader.dropped_frames)
+    assert list(corrupted_values) == samples * 99
+
+    # ASCII lines, as sent by the legacy firmware
+    port = LoopbackPort()
+    reader = SampleReader(port)
+    lines = b"".join(f"{value:.2f}\r\n".encode() for value in samples)
+    for _ in range(frames):
+        port.write(lines)
+    times, values = new_sample_arrays()
+    start = time.perf_counter()
+    while len(values) < total:
+        reader.read_batch(times, values)
+    ascii_rate = total / (time.perf_counter() - start)
+
+    print(f"protocol: binary {binary_rate:,.0f} samples/s, ASCII {ascii_rate:,.0f} samples/s")
+
+
+def bench_buffer(batches=20000, batch_size=SAMPLES_PER_FRAME):
+    """Producer/consumer throughput of the sample ring buffer across two threads."""
+    buffer = SampleRingBuffer()
+    times, values = new_sample_arrays()
+    times.extend(range(batch_size))
+    values.extend(range(batch_size))
+    total = batches * batch_size
+
+    def produce():
+        for _ in range(batches):
+            # Back off while full so this measures throughput, not overruns
+            while buffer.capacity - len(buffer) < batch_size:
+                time.sleep(0)
+            buffer.write(times, values)
+
+    producer = threading.Thread(target=produce)
+    out_times, out_values = new_sample_arrays()
+    start = time.perf_counter()
+    producer.start()
+    received = 0
+    while received < total:
+        received += buffer.read(out_times, out_values)
+        del out_times[:], out_values[:]
+    producer.join()
+    rate = total / (time.perf_counter() - start)
+
+    print(f"buffer: {rate:,.0f} samples/s, {buffer.stats()}")
+
+
+def synthetic_trace(seconds=60.0, rate=10000, lap_time=2.0, shadow_time=0.02, noise=15.0):
+    """Bright baseline with a short dip every lap_time seconds, returns (times, values, crossings)."""
+    times, values = new_sample_arrays()
+    bright, dim = 600.0, 100.0
+    crossings = [lap_time / 2 + k * lap_time for k in range(int(seconds / lap_time))]
+    for i in range(int(seconds * rate)):
+        t = i / rate
+        shadow = 0 <= (t - lap_time / 2) % lap_time < shadow_time
+        times.append(t)
+        values.append((dim if shadow else bright) + random.gauss(0, noise))
+    return times, values, crossings
+
+
+def bench_detector(block_size=512):
+    """Lap detection throughput on a 10 kHz synthetic trace, fed in acquisition-sized blocks."""
+    times, values, crossings = synthetic_trace()
+    detector = LapDetector.from_levels(600, 100)
+    found = []
+    start = time.perf_counter()
+    for offset in range(0, len(values), block_size):
+        found += detector.process(times[offset : offset + block_size], values[offset : offset + block_size])
+    rate = len(values) / (time.perf_counter() - start)
+
+    assert len(found) == len(crossings), (len(found), len(crossings))
+    error = max(abs(a - b) for a, b in zip(found, crossings))
+    print(f"detector: {rate:,.0f} samples/s, {len(found)} laps, max timing error {error * 1000:.2f} ms")
+
+
+def bench_calibration(samples=100000):
+    """Streaming level estimation cost, and how much a waving hand moves the result."""
+    values = [600 + random.gauss(0, 5) for _ in range(samples)]
+    # A hand passing the sensor for 5% of the measurement
+    values[samples // 2 : samples // 2 + samples // 20] = [80.0] * (samples // 20)
+    level = LevelEstimate()
+    start = time.perf_counter()
+    level.add_all(values)
+    rate = samples / (time.perf_counter() - start)
+    print(
+        f"calibration: {rate:,.0f} samples/s, median {level.median:.1f} (mean {level.mean:.1f}), "
+        f"noise {level.noise:.1f} (stddev {level.variance ** 0.5:.1f})"
+    )
+
+
+class FakeAppsScript(ThreadingHTTPServer):
+    """Local stand-in for the leaderboard's Apps Script endpoint.
+
+    Keeps rows by their "Key" column like the real script should, and fails
+    every fail_every-th request to exercise the retries. Refuses a request
+    with a row without an e-mail address the way Apps Script reports
+    errors: HTTP 200 with an error result.
+    """
+
+    def __init__(self, fail_every=0):
+        super().__init__(("127.0.0.1", 0), _FakeAppsScriptHandler)
+        self.fail_every = fail_every
+        self.requests = 0
+        self.rows = {}
+        self.duplicates = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/exec"
+
+
+class _FakeAppsScriptHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            failing = server.fail_every and server.requests % server.fail_every == 0
+            refused = not all("@" in row["E-mail"] for row in body["values"])
+            if not failing and not refused:
+                for row in body["values"]:
+                    server.duplicates += row["Key"] in server.rows
+                    server.rows[row["Key"]] = row
+        self.send_response(503 if failing else 200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(b'{"result": "error", "error": "Invalid e-mail"}' if refused else b'{"result": "success"}')
+
+    def log_message(self, *args):
+        pass
+
+
+def bench_upload(results=5000, bad_results=3):
+    """Flushes a large backlog of queued results to a local, flaky Apps Script stand-in.
+
+    A few results the sheet refuses are queued early on; they must be
+    parked without holding up the others. Before that, a spell offline
+    must not park anything.
+    """
+    server = FakeAppsScript(fail_every=7)
+    with tempfile.TemporaryDirectory() as directory:
+        outbox = Outbox(os.path.join(directory, "outbox.sqlite3"))
+        rows = [
+            (uuid.uuid4().hex, make_row(f"Racer {i}", f"racer{i}@example.com", 1, random.uniform(20, 90)))
+            for i in range(results)
+        ]
+        for i in range(bad_results):
+            rows.insert(i * 10, (uuid.uuid4().hex, make_row(f"Bad {i}", "no address", 1, 30.0)))
+        outbox.add_many(rows)
+        # Queueing the same results again, e.g. after a crash, must not duplicate them
+        assert outbox.add_many(rows[:100]) == 0
+
+        # However long the booth is offline, nothing is given up on
+        offline = Uploader(outbox, url="http://127.0.0.1:9/exec", min_backoff=0.001, max_backoff=0.01)
+        offline.start()
+        while offline.failures < 30:
+            time.sleep(0.01)
+        offline.stop()
+        offline.join()
+        assert outbox.parked_count() == 0 and outbox.pending_count() == len(rows)
+
+        uploader = Uploader(outbox, url=server.url, min_backoff=0.01, max_backoff=0.1)
+        start = time.perf_counter()
+        uploader.start()
+        assert uploader.flush(timeout=120)
+        rate = results / (time.perf_counter() - start)
+        uploader.stop()
+        parked = outbox.parked_count()
+
+    assert len(server.rows) == results and server.duplicates == 0
+    assert parked == bad_results, parked
+    print(f"upload: {rate:,.0f} results/s, {server.requests} requests, {uploader.sent} sent, {parked} parked")
+    server.shutdown()
+
+
+def bench_import(results=20000, workers=4):
+    """Bulk import of a results file with duplicates and bad rows, then the same file again."""
+    server = FakeAppsScript(fail_every=11)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "results.csv")
+        with open(path, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["Timestamp", "Name", "E-mail", "Track", "Time"])
+            for i in range(results):
+                if i % 100 == 99:
+                    writer.writerow(["2024-05-01 12:00:00", f"Racer {i}", "not an address", 1, "00:30:00"])
+                elif i % 10 == 9:
+                    # The same result again, the way two laptops' exports overlap
+                    writer.writerow(["2024-05-01 12:00:00", f"Racer {i - 1}", f"racer{i - 1}@example.com", "Track 1", 20 + (i - 1) % 70])
+                else:
+                    writer.writerow(["2024-05-01 12:00:00", f"Racer {i}", f"racer{i}@example.com", "Track 1", 20 + i % 70])
+
+        outbox = Outbox(os.path.join(directory, "outbox.sqlite3"))
+        stderr, sys.stderr = sys.stderr, open(os.devnull, "w")  # Skipped rows and retries
+        try:
+            stats = import_files([path], outbox, server.url, workers=workers, backoff=0.01)
+            again = import_files([path], outbox, server.url, workers=workers, backoff=0.01)
+        finally:
+            sys.stderr.close()
+            sys.stderr = stderr
+
+    invalid, duplicates = results // 100, results // 10 - results // 100
+    assert stats.invalid == invalid and stats.skipped == duplicates and stats.failed == 0, stats
+    assert len(server.rows) == stats.sent == results - invalid - duplicates and server.duplicates == 0
+    assert again.sent == 0 and again.skipped == results - invalid, again
+    print(f"import: {stats}, {server.requests} requests; again: {again.rate:,.0f} rows/s, nothing sent")
+    server.shutdown()
+
+
+def bench_leaderboard(results=100000, queries=10000):
+    """Startup, insert and query latency of the local leaderboard with a full event's worth of results."""
+    days = ["2025-03-20", "2025-03-21", "2025-03-22"]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "leaderboard.sqlite3")
+        leaderboard = Leaderboard(path)
+        leaderboard._db.executemany(
+            "INSERT INTO results (track, day, name, email, elapsed_time, recorded) VALUES (?, ?, ?, ?, ?, 0)",
+            (
+                (random.randint(1, 4), random.choice(days), f"Racer {i}", f"racer{i % 5000}@example.com", random.uniform(20, 90))
+                for i in range(results)
+            ),
+        )
+        leaderboard._db.commit()
+        leaderboard._db.close()
+
+        start = time.perf_counter()
+        leaderboard = Leaderboard(path)
+        load_time = time.perf_counter() - start
+        assert len(leaderboard) == results
+
+        def per_call(function):
+            start = time.perf_counter()
+            for _ in range(queries):
+                function()
+            return (time.perf_counter() - start) / queries * 1e6
+
+        rank = per_call(lambda: leaderboard.rank(2, random.uniform(20, 90), days[1]))
+        top = per_call(lambda: leaderboard.top(2, 10, days[1]))
+        best = per_call(lambda: leaderboard.personal_best(2, f"racer{random.randrange(5000)}@example.com"))
+        add = per_call(lambda: leaderboard.add("New racer", "new@example.com", 2, random.uniform(20, 90), days[1]))
+        leaderboard._db.close()
+
+    print(
+        f"leaderboard: {results:,} results loaded in {load_time:.2f} s, "
+        f"rank {rank:.1f} us, top-10 {top:.1f} us, personal best {best:.1f} us, add {add:.1f} us"
+    )
+
+
+def bench_splits(races=20000, number_laps=7):
+    """Split analysis over a whole event's stored races on one track, and what a race costs to store."""
+    with tempfile.TemporaryDirectory() as directory:
+        leaderboard = Leaderboard(os.path.join(directory, "leaderboard.sqlite3"))
+        stored = []
+        for i in range(races):
+            crossings = [0.0]
+            for _ in range(number_laps):
+                crossings.append(crossings[-1] + random.uniform(3, 12))
+            stored.append(RaceResult(crossings))
+        leaderboard._db.executemany(
+            "INSERT INTO results (track, day, name, email, elapsed_time, recorded, crossings) "
+            "VALUES (1, '2025-03-21', ?, ?, ?, 0, ?)",
+            (
+                (f"Racer {i}", f"racer{i}@example.com", result.elapsed_time, result.to_bytes())
+                for i, result in enumerate(stored)
+            ),
+        )
+        leaderboard._db.commit()
+
+        start = time.perf_counter()
+        statistics = leaderboard.split_statistics(1, percentiles=(10, 50, 90, 99))
+        analysis_time = time.perf_counter() - start
+        leaderboard._db.close()
+
+    assert statistics["races"] == races and statistics["laps"] == races * number_laps
+    assert statistics["fastest_lap"] == min(min(result.splits) for result in stored)
+    percentiles = ", ".join(f"p{percent} {value:.2f} s" for percent, value in statistics["percentiles"].items())
+    print(
+        f"splits: {races:,} races analysed in {analysis_time * 1000:.0f} ms, "
+        f"{len(stored[0].to_bytes())} bytes stored per race, fastest lap {statistics['fastest_lap']:.2f} s, {percentiles}"
+    )
+
+
+def bench_lanes(lanes=8, seconds=5.0, period_us=250, lap_time=0.5):
+    """Eight tracks at 4 kHz each in real time, checking that no lane misses samples or laps."""
+    session = LaneSession([Lane(track, LoopbackPort()) for track in range(1, lanes + 1)])
+    for lane in session.lanes:
+        lane.sensor.binary = True
+    session.start(negotiate=False)
+
+    frame_time = SAMPLES_PER_FRAME * period_us / 1e6
+    frames = int(seconds / frame_time)
+    expected_laps = int(seconds / lap_time)
+
+    def arduino(lane):
+        # Writes frames at the rate the firmware would, with a shadow every lap_time,
+        # the first one half a lap in
+        start = time.perf_counter()
+        for sequence in range(frames):
+            t0 = sequence * frame_time
+            samples = [
+                100 if (t0 + i * period_us / 1e6 + lap_time / 2) % lap_time < 0.01 else 600
+                for i in range(SAMPLES_PER_FRAME)
+            ]
+            lane.port.write(encode_frame(sequence, int(t0 * 1e6), period_us, samples))
+            time.sleep(max(0.0, start + (sequence + 1) * frame_time - time.perf_counter()))
+
+    laps = {}
+
+    def race(lane):
+        detector = LapDetector(300, 400, debounce_time=lap_time / 2)
+        times, values = new_sample_arrays()
+        count = 0
+        while lane.running or len(lane.samples):
+            del times[:], values[:]
+            lane.samples.read(times, values)
+            count += len(detector.process(times, values))
+            time.sleep(0.005)
+        laps[lane.track] = count
+
+    start_cpu = time.process_time()
+    threads = []
+    for lane in session.lanes:
+        lane.running = True
+        threads.append(threading.Thread(target=race, args=(lane,)))
+        threads.append(threading.Thread(target=arduino, args=(lane,)))
+    for thread in threads:
+        thread.start()
+    for thread in threads[1::2]:
+        thread.join()
+    time.sleep(0.1)  # Let the acquisition threads drain the ports
+    for lane in session.lanes:
+        lane.running = False
+    for thread in threads[::2]:
+        thread.join()
+    cpu = time.process_time() - start_cpu
+    session.close()
+
+    for lane in session.lanes:
+        assert lane.sensor.frames == frames and lane.sensor.dropped_frames == 0, str(lane)
+        assert lane.samples.overruns == 0 and laps[lane.track] == expected_laps, str(lane)
+    rate = lanes * frames * SAMPLES_PER_FRAME / seconds
+    high_water = max(lane.samples.high_water for lane in session.lanes)
+    print(
+        f"lanes: {lanes} lanes, {rate:,.0f} samples/s total, no missed samples or laps, "
+        f"buffer high-water {high_water}, CPU {cpu / seconds:.0%}"
+    )
+
+
+def bench_idle(seconds=5.0):
+    """CPU use and thread wakeups of one lane in the idle and race sampling modes.
+
+    The frames come from a writer thread paced like the firmware, which
+    sleeps between them, so the process CPU is mostly the host's own
+    acquisition and consumer threads.
+    """
+    for name, mode in (("idle", IDLE_MODE), ("race", RACE_MODE)):
+        lane = Lane(1, LoopbackPort())
+        lane.sensor.binary = True
+        lane.start(negotiate=False)
+        lane.sensor.set_mode(mode)
+        # Folded readings arrive as (min, max) pairs, see sensor_protocol
+        period_us = mode.period_us if mode.decimation == 1 else mode.period_us * mode.decimation // 2
+        frame_time = SAMPLES_PER_FRAME * period_us / 1e6
+        frames = int(seconds / frame_time)
+        samples = [600] * SAMPLES_PER_FRAME
+
+        def arduino():
+            start = time.perf_counter()
+            for sequence in range(frames):
+                lane.port.write(encode_frame(sequence, int(sequence * frame_time * 1e6), period_us, samples))
+                time.sleep(max(0.0, start + (sequence + 1) * frame_time - time.perf_counter()))
+
+        consumer_wakeups = 0
+        received = 0
+        times, values = new_sample_arrays()
+        writer = threading.Thread(target=arduino)
+        start_cpu = time.process_time()
+        writer.start()
+        # Consumes like the race loop does, blocking until samples arrive
+        while writer.is_alive() or len(lane.samples):
+            consumer_wakeups += 1
+            if lane.samples.wait(0.05):
+                received += lane.samples.read(times, values)
+                del times[:], values[:]
+        cpu = time.process_time() - start_cpu
+        lane.stop()
+
+        assert received == frames * SAMPLES_PER_FRAME and lane.sensor.dropped_frames == 0
+        wakeups = lane.acquisition_thread.wakeups + consumer_wakeups
+        print(
+            f"idle: {name} mode, {received / seconds:,.0f} samples/s, "
+            f"{wakeups / seconds:,.0f} wakeups/s, CPU {cpu / seconds:.1%}"
+        )
+
+
+def bench_replay(races=20, race_seconds=20.0, rate=4000, lap_time=2.0):
+    """Re-times a whole event's worth of recorded races as fast as possible."""
+    times, values, crossings = synthetic_trace(seconds=race_seconds, rate=rate, lap_time=lap_time)
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for race in range(races):
+            path = os.path.join(directory, f"race{race}.rtrace")
+            writer = TraceWriter(path, 1, 300, 400)
+            for offset in range(0, len(values), 128):
+                writer.write(times[offset : offset + 128], values[offset : offset + 128])
+            writer.close()
+            paths.append(path)
+
+        start = time.perf_counter()
+        for path in paths:
+            timer = replay_race(path, number_laps=len(crossings) - 1)
+            assert timer.finished and abs(timer.elapsed_time - (crossings[-1] - crossings[0])) < 1e-3
+        elapsed = time.perf_counter() - start
+
+    samples = races * len(values)
+    print(f"replay: {races} races ({races * race_seconds / 60:.0f} min of samples) in {elapsed:.2f} s, {samples / elapsed:,.0f} samples/s")
+
+
+def bench_metrics(records=1000000):
+    """Cost of recording a latency, with metrics enabled and disabled."""
+    for enabled in (True, False):
+        histogram = Metrics(enabled).histogram("bench")
+        start = time.perf_counter()
+        for _ in range(records):
+            histogram.record(0.0012)
+        per_record = (time.perf_counter() - start) / records * 1e9
+        print(f"metrics: {'enabled' if enabled else 'disabled'} {per_record:.0f} ns per record")
+
+
+def wait_for_race_rate(arduino):
+    """Until the simulated firmware has switched to RACE_MODE.
+
+    At `speed` the car would otherwise be on the line before the host's
+    RATE command gets through, and be timed from idle mode's folded samples.
+    """
+    while (arduino.period_us, arduino.decimation) != RACE_MODE:
+        time.sleep(0.001)
+
+
+def lost_samples(session):
+    """Samples the lanes' readers lost, to buffer overruns or dropped frames."""
+    return sum(lane.samples.overruns + SAMPLES_PER_FRAME * lane.sensor.dropped_frames for lane in session.lanes)
+
+
+def wait_for_device_time(arduino, until):
+    while arduino.now() < until:
+        time.sleep(0.01)
+
+
+def next_snapshot(subscription, until):
+    """The first of the engine's snapshots for which until(snapshot) holds, polled like the UI does."""
+    while (snapshot := subscription.poll()) is None or not until(snapshot):
+        time.sleep(0.01)
+    return snapshot
+
+
+def run_engine_races(engine, subscription, arduinos, races, number_laps):
+    """Races every track of the engine on its simulated Arduino, the way the UI drives it.
+
+    Starts all tracks' races at once, saves each result once they're all
+    finished, and compares them with the simulator's ground truth. Returns
+    the race time errors, the lap split errors and the number of snapshots
+    published by the end of the last race.
+    """
+    next_snapshot(subscription, lambda snapshot: snapshot.ready)
+    snapshots, errors, split_errors = 0, [], []
+    crossings = {}
+    for _ in range(races):
+        # The car clears each sensor before the next race starts
+        for track, times in crossings.items():
+            wait_for_device_time(arduinos[track - 1], times[-1] + 1.0)
+        crossings = {}
+        for track, arduino in enumerate(arduinos, start=1):
+            engine.start_race(track, f"Racer {track}", f"racer{track}@example.com")
+            wait_for_race_rate(arduino)
+            crossings[track] = arduino.start_race(number_laps, delay=0.5)
+        # The UI only sees the newest snapshot when it polls, like here
+        finished = next_snapshot(
+            subscription, lambda snapshot: all(view.state.phase == "finished" for view in snapshot.lanes)
+        )
+        for view in finished.lanes:
+            truth = crossings[view.track][-1] - crossings[view.track][0]
+            errors.append(abs(view.state.elapsed_time - truth))
+            true_splits = RaceResult(crossings[view.track]).splits
+            split_errors += map(abs, map(float.__sub__, view.result.splits, true_splits))
+            engine.save_result(view.track)
+        snapshots = finished.sequence
+        next_snapshot(subscription, lambda snapshot: all(view.owner == "ambient" for view in snapshot.lanes))
+    return errors, split_errors, snapshots
+
+
+def bench_simulator(lanes=4, races=3, number_laps=7, speed=10.0):
+    """End to end without hardware: simulated Arduinos through negotiation, calibration and races.
+
+    Uses the app's own lanes, calibration procedure and race loop, only the
+    UI is left out. Compares every race against the simulator's ground truth.
+    The simulated clock runs `speed` times faster than real time.
+    """
+    arduinos = [SimulatedArduino(speed=speed, seed=track) for track in range(lanes)]
+    session = LaneSession([Lane(track, arduino.port) for track, arduino in enumerate(arduinos, start=1)])
+    for arduino in arduinos:
+        arduino.start()
+
+    start, start_cpu = time.perf_counter(), time.process_time()
+    session.start()
+    results = {}
+    overruns = dict.fromkeys(range(1, lanes + 1), 0)
+
+    def calibrate(lane, arduino):
+        # Follows the operator prompts on the device clock, at full rate like the app
+        lane.sensor.set_mode(RACE_MODE)
+        calibration_run = CalibrationRun(clock=arduino.now)
+        times, values = new_sample_arrays()
+        while (prompt := calibration_run.update()) is not None:
+            if prompt == "Clear sensor please":
+                arduino.covered = False
+            elif prompt == "Cover sensor please":
+                arduino.covered = True
+            del times[:], values[:]
+            lane.samples.read(times, values)
+            calibration_run.feed(values)
+            time.sleep(0.005)
+        arduino.covered = False
+        lane.sensor.set_mode(IDLE_MODE)
+        lane.calibration = calibration_run.result()
+        wait_for_device_time(arduino, arduino.now() + 1.0)  # Hand away from the sensor
+
+    def race(lane, arduino):
+        calibrate(lane, arduino)
+        results[lane.track] = []
+        for _ in range(races):
+            lane.owner, lane.running = "race", True
+            before = lane.samples.overruns
+            timers = []
+            runner = threading.Thread(target=lambda: timers.append(run_race(lane, number_laps)))
+            runner.start()
+            wait_for_race_rate(arduino)
+            crossings = arduino.start_race(number_laps, delay=0.5)
+            # Give up on the race a little after the car's last crossing
+            wait_for_device_time(arduino, crossings[-1] + 1.0)
+            runner.join(0.5)
+            lane.running = False
+            runner.join()
+            # Between races nobody reads the lane here, only count what a race missed
+            overruns[lane.track] += lane.samples.overruns - before
+            lane.owner, lane.state = "ambient", IDLE
+            results[lane.track].append((crossings, timers[0]))
+
+    threads = [threading.Thread(target=race, args=pair) for pair in zip(session.lanes, arduinos)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed, cpu = time.perf_counter() - start, time.process_time() - start_cpu
+    session.close()
+    for arduino in arduinos:
+        arduino.stop()
+
+    missed_laps, extra_laps, lap_errors, race_errors = 0, 0, [], []
+    for track_results in results.values():
+        for crossings, timer in track_results:
+            # A detection belongs to the true crossing it's closest to, within 50 ms
+            errors = {}
+            for found in timer.crossings:
+                truth = min(crossings, key=lambda truth: abs(found - truth))
+                if abs(found - truth) < 0.05:
+                    errors[truth] = found - truth
+                else:
+                    extra_laps += 1
+            missed_laps += len(crossings) - len(errors)
+            lap_errors += map(abs, errors.values())
+            if timer.finished and len(errors) == len(crossings):
+                race_errors.append(abs(timer.elapsed_time - (crossings[-1] - crossings[0])))
+    samples = sum(arduino.samples_sent for arduino in arduinos)
+    missed_samples = sum(overruns.values()) + SAMPLES_PER_FRAME * sum(
+        lane.sensor.dropped_frames for lane in session.lanes
+    )
+    print(
+        f"simulator: {lanes} lanes x {races} races, {samples / elapsed:,.0f} samples/s, "
+        f"{missed_samples} missed samples, {missed_laps} missed and {extra_laps} extra laps, "
+        f"lap error max {max(lap_errors, default=0) * 1000:.2f} ms, "
+        f"race time error max {max(race_errors, default=0) * 1000:.2f} ms, CPU {cpu / elapsed:.0%}"
+    )
+    assert missed_samples == 0 and missed_laps == 0 and extra_laps == 0, "simulated races not seen right"
+    assert max(race_errors) < 0.001, "simulated races timed wrong"
+
+
+def bench_engine(lanes=4, races=3, number_laps=7, speed=10.0):
+    """Races on simulated Arduinos through the race engine, the way the UI drives it.
+
+    Only talks to the engine through its commands and snapshots, and checks
+    every finished race against the simulator's ground truth.
+    """
+    arduinos = [SimulatedArduino(speed=speed, seed=track) for track in range(lanes)]
+    session = LaneSession([Lane(track, arduino.port) for track, arduino in enumerate(arduinos, start=1)])
+    for arduino in arduinos:
+        arduino.start()
+
+    def connect():
+        session.start()
+        return session, None, None
+
+    engine = RaceEngine(connect, number_laps=number_laps)
+    subscription = engine.subscribe(depth=64)
+    start, start_cpu = time.perf_counter(), time.process_time()
+    engine.start()
+    errors, split_errors, snapshots = run_engine_races(engine, subscription, arduinos, races, number_laps)
+    elapsed, cpu = time.perf_counter() - start, time.process_time() - start_cpu
+    engine.stop()
+    for arduino in arduinos:
+        arduino.stop()
+
+    print(
+        f"engine: {lanes} lanes x {races} races, race time error max {max(errors) * 1000:.2f} ms, "
+        f"lap split error max {max(split_errors) * 1000:.2f} ms, "
+        f"{snapshots} snapshots published, CPU {cpu / elapsed:.0%}"
+    )
+    assert max(errors) < 0.001 and max(split_errors) < 0.001, "engine races timed wrong"
+    assert lost_samples(session) == 0, "engine lanes missed samples"
+
+
+def bench_spectators(clients=300, slow_clients=30, lanes=4, races=6, number_laps=5, speed=10.0):
+    """Hundreds of local spectator clients following races on simulated Arduinos.
+
+    The slow clients don't read during the races, so the server has to
+    skip sends to them; they must still end up with the final state once
+    they read again. Checks that the races are timed as accurately with the
+    clients connected.
+    """
+    arduinos = [SimulatedArduino(speed=speed, seed=track) for track in range(lanes)]
+    session = LaneSession([Lane(track, arduino.port) for track, arduino in enumerate(arduinos, start=1)])
+    for arduino in arduinos:
+        arduino.start()
+    directory = tempfile.mkdtemp()
+
+    def connect():
+        session.start()
+        return session, Leaderboard(os.path.join(directory, "leaderboard.sqlite3")), None
+
+    engine = RaceEngine(connect, number_laps=number_laps)
+    # Small buffers, so the slow clients fall behind within a few events
+    server = SpectatorServer(engine, host="127.0.0.1", port=0, max_backlog=0, send_buffer=1024)
+    subscription = engine.subscribe(depth=64)
+    engine.start()
+    server.start()
+    server.ready.wait()
+
+    def final_state(state):
+        lanes_done = len(state["lanes"]) == lanes and all(lane["phase"] == "idle" for lane in state["lanes"].values())
+        return lanes_done and sum(len(times) for times in state["top"].values()) == lanes * races
+
+    async def spectator(states, received, reading, receive_buffer=None):
+        sock = socket.socket()
+        if receive_buffer is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)  # Before the window is set
+        sock.setblocking(False)
+        await loop.sock_connect(sock, ("127.0.0.1", server.port))
+        await loop.sock_sendall(sock, b"GET /events HTTP/1.1\r\nHost: booth\r\n\r\n")
+        state = {"lanes": {}, "top": {}}
+        states.append(state)
+        # Nothing is read from the socket until then, not even into a stream's buffer
+        await reading.wait()
+        reader, writer = await asyncio.open_connection(sock=sock)
+        await reader.readuntil(b"\r\n\r\n")
+        while not final_state(state):
+            line = await reader.readline()
+            if line.startswith(b"data: "):
+                received.append(len(line))
+                update = json.loads(line[6:])
+                for section in state:
+                    state[section].update(update.get(section, {}))
+        writer.close()
+
+    loop = asyncio.new_event_loop()
+    fast_states, slow_states, received = [], [], []
+
+    async def connect_spectators():
+        fast_reading, slow_reading = asyncio.Event(), asyncio.Event()
+        fast_reading.set()
+        tasks = [loop.create_task(spectator(fast_states, received, fast_reading)) for _ in range(clients - slow_clients)]
+        tasks += [
+            loop.create_task(spectator(slow_states, [], slow_reading, receive_buffer=1024)) for _ in range(slow_clients)
+        ]
+        return tasks, slow_reading
+
+    tasks, slow_reading = loop.run_until_complete(connect_spectators())
+    spectators = threading.Thread(target=loop.run_until_complete, args=(asyncio.gather(*tasks),))
+    start, start_cpu = time.perf_counter(), time.process_time()
+    spectators.start()
+    errors, _, _ = run_engine_races(engine, subscription, arduinos, races, number_laps)
+    loop.call_soon_threadsafe(slow_reading.set)
+    spectators.join(30)
+    elapsed, cpu = time.perf_counter() - start, time.process_time() - start_cpu
+    stats = server.stats()
+    server.stop()
+    engine.stop()
+    for arduino in arduinos:
+        arduino.stop()
+
+    assert not spectators.is_alive(), "spectators didn't all get the final state"
+    assert len(fast_states) + len(slow_states) == clients
+    assert all(map(final_state, slow_states)) and stats["skipped"] > 0, "slow clients weren't caught up"
+    assert max(errors) < 0.001 and lost_samples(session) == 0, "races timed wrong with spectators"
+    print(
+        f"spectators: {clients} clients ({slow_clients} slow), {len(received) / elapsed:,.0f} events/s delivered, "
+        f"{sum(received) / len(received):.0f} bytes/event, {stats['skipped']} sends skipped for slow clients, "
+        f"tick max {stats['max_tick_ms']:.1f} ms, race time error max {max(errors) * 1000:.2f} ms, CPU {cpu / elapsed:.0%}"
+    )
+
+
+# Startup budgets of the UI: interpreter plus module-level imports, and until the main screen shows
+IMPORT_BUDGET = 0.3  # seconds
+FIRST_FRAME_BUDGET = 1.0
+
+
+def bench_startup(runs=5):
+    """Time to first frame of the UI, and which imports it spends its time on."""
+    ui_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "racetrack-counter-ui.py")
+    # Loads the script as a module without running the app (the name isn't importable)
+    load_ui = (
+        "import importlib.util\n"
+        f"spec = importlib.util.spec_from_file_location('racetrack_ui', {ui_script!r})\n"
+        "spec.loader.exec_module(importlib.util.module_from_spec(spec))\n"
+    )
+
+    # -X importtime writes "import time: self [us] | cumulative | imported package" to stderr
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", load_ui], capture_output=True, text=True, check=True
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        fields = line.removeprefix("import time:").split("|")
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            imports.append((int(fields[1]), fields[2].rstrip()))
+    # Top-level imports only, i.e. the ones the script (or its modules) asked for directly
+    top_level = sorted((item for item in imports if not item[1].startswith("  ")), reverse=True)
+    for cumulative, name in top_level[:8]:
+        print(f"startup: import {name.strip():<24} {cumulative / 1000:6.1f} ms")
+
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", load_ui], check=True)
+        timings.append(time.perf_counter() - start)
+    import_time = min(timings)
+    verdict = "within" if import_time <= IMPORT_BUDGET else "OVER"
+    print(f"startup: interpreter + imports {import_time * 1000:.0f} ms, {verdict} the {IMPORT_BUDGET * 1000:.0f} ms budget")
+
+    # The app quits right after its first frame with this flag set; needs a display
+    environment = dict(os.environ, RACETRACK_EXIT_AFTER_FIRST_FRAME="1")
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, ui_script], env=environment, capture_output=True, text=True)
+    first_frame = time.perf_counter() - start
+    if result.returncode != 0:
+        print("startup: first frame skipped, the UI can't start here (no display?)")
+        return
+
+    verdict = "within" if first_frame <= FIRST_FRAME_BUDGET else "OVER"
+    print(f"startup: first frame after {first_frame * 1000:.0f} ms, {verdict} the {FIRST_FRAME_BUDGET * 1000:.0f} ms budget")
+
+
+BENCHMARKS = {
+    "protocol": bench_protocol,
+    "buffer": bench_buffer,
+    "detector": bench_detector,
+    "calibration": bench_calibration,
+    "upload": bench_upload,
+    "import": bench_import,
+    "leaderboard": bench_leaderboard,
+    "splits": bench_splits,
+    "lanes": bench_lanes,
+    "idle": bench_idle,
+    "replay": bench_replay,
+    "metrics": bench_metrics,
+    "simulator": bench_simulator,
+    "engine": bench_engine,
+    "spectators": bench_spectators,
+    "startup": bench_startup,
+}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -0,0 +1,306 @@
+"""Bulk import of race results into the Google Sheets leaderboard, and export.
+
+    python upload-to-gsheets.py import results.csv laptop2.jsonl
+    python upload-to-gsheets.py export all-results.csv
+
+Files are CSV with a header row, or JSON lines, with the sheet's columns:
+Timestamp, Name, E-mail, Track and Time (mm:ss:hh, or seconds), and
+optionally Laps (lap times in seconds, space-separated). Rows are
+streamed through a chain of generators, read -> normalize -> batch ->
+queue, so memory use doesn't grow with the file. Batches are sent by a
+bounded pool of threads, each with its own HTTP session.
+
+Rows go through the same outbox as the booth's uploads, keyed by a hash of
+their content: rows that were sent before or repeat within the import are
+skipped, and rows that fail stay queued and go out with the next import or
+the next time the app runs.
+An export writes everything in the outbox, e.g. to merge laptops.
+"""
+
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import csv
+from itertools import islice
+import json
+import math
+import os
+import sys
+import threading
+import time
+
+from uploader import GSHEET_URL, Outbox, make_row, new_session, post_rows, row_key
+
+COLUMNS = ("Timestamp", "Name", "E-mail", "Track", "Time")
+OPTIONAL_COLUMNS = ("Laps",)
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+# Accepted spellings of the column names, e.g. from hand-made spreadsheets
+_COLUMN_NAMES = {
+    "timestamp": "Timestamp",
+    "name": "Name",
+    "e-mail": "E-mail",
+    "email": "E-mail",
+    "track": "Track",
+    "time": "Time",
+    "elapsed_time": "Time",
+    "laps": "Laps",
+    "splits": "Laps",
+}
+
+
+def is_jsonl(path):
+    return os.path.splitext(path)[1].lower() in (".jsonl", ".ndjson", ".json")
+
+
+def read_records(path):
+    """Yields (line number, record) for each row of a CSV or JSON lines file.
+
+    Records are dicts for CSV, unparsed lines for JSON lines; parsing is
+    left to normalize_rows() so a bad line is reported like any other bad row.
+    """
+    # utf-8-sig: Excel puts a byte order mark in front of its CSV files
+    with open(path, newline="", encoding="utf-8-sig") as file:
+        if is_jsonl(path):
+            for line_number, line in enumerate(file, start=1):
+                if line.strip():
+                    yield line_number, line
+        else:
+            reader = csv.DictReader(file)
+            for record in reader:
+                yield reader.line_num, record
+
+
+def parse_time(value):
+    """Seconds from the sheet's mm:ss:hh, or from a plain number of seconds."""
+    if isinstance(value, str) and ":" in value:
+        minutes, seconds, hundredths = (int(part) for part in value.split(":"))
+        if not (0 <= seconds < 60 and 0 <= hundredths < 100):
+            raise ValueError(value)
+        return minutes * 60 + seconds + hundredths / 100
+    return float(value)
+
+
+def parse_track(value):
+    """Track number from 2, "2" or "Track 2"."""
+    if isinstance(value, str):
+        value = value.strip().removeprefix("Track").strip()
+    return int(value)
+
+
+def normalize_row(record):
+    """Validates a record and returns it as make_row() builds it, raises ValueError if it's bad."""
+    if isinstance(record, str):
+        try:
+            record = json.loads(record)
+        except ValueError:
+            raise ValueError("not valid JSON") from None
+        if not isinstance(record, dict):
+            raise ValueError("not a JSON object")
+    record = {_COLUMN_NAMES.get(str(column).strip().lower()): value for column, value in record.items()}
+
+    missing = [column for column in COLUMNS if record.get(column) in (None, "")]
+    if missing:
+        raise ValueError(f"missing {', '.join(missing)}")
+
+    name = str(record["Name"]).strip()
+    email = str(record["E-mail"]).strip()
+    # Same checks as the booth's entry form
+    if not name:
+        raise ValueError("empty name")
+    if "@" not in email or "." not in email:
+        raise ValueError(f"invalid e-mail address {email!r}")
+    try:
+        track = parse_track(record["Track"])
+    except ValueError:
+        raise ValueError(f"invalid track {record['Track']!r}") from None
+    try:
+        elapsed_time = parse_time(record["Time"])
+    except ValueError:
+        raise ValueError(f"invalid time {record['Time']!r}") from None
+    if not (elapsed_time > 0 and math.isfinite(elapsed_time)):
+        raise ValueError(f"invalid time {record['Time']!r}")
+    try:
+        timestamp = time.strftime(TIMESTAMP_FORMAT, time.strptime(str(record["Timestamp"]).strip(), TIMESTAMP_FORMAT))
+    except ValueError:
+        raise ValueError(f"invalid timestamp {record['Timestamp']!r}, expected YYYY-MM-DD HH:MM:SS") from None
+    try:
+        splits = [float(split) for split in str(record.get("Laps") or "").split()]
+    except ValueError:
+        raise ValueError(f"invalid laps {record['Laps']!r}") from None
+    if not all(map(math.isfinite, splits)):
+        raise ValueError(f"invalid laps {record['Laps']!r}")
+
+    return make_row(name, email, track, elapsed_time, timestamp, splits)
+
+
+def normalize_rows(records, stats, source=""):
+    """Yields the valid records as rows, counting and reporting the invalid ones."""
+    for line_number, record in records:
+        stats.read += 1
+        try:
+            yield normalize_row(record)
+        except ValueError as error:
+            stats.invalid += 1
+            print(f"{source}:{line_number}: skipped, {error}", file=sys.stderr)
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+class ImportStats:
+    def __init__(self):
+        self.read = 0
+        self.invalid = 0
+        self.skipped = 0
+        self.sent = 0
+        self.failed = 0
+        self.started = time.perf_counter()
+
+    @property
+    def rate(self):
+        return self.read / max(time.perf_counter() - self.started, 1e-9)
+
+    def __str__(self):
+        return (
+            f"{self.read:,} rows read, {self.sent:,} sent, {self.skipped:,} skipped as duplicates, "
+            f"{self.invalid:,} invalid, {self.failed:,} failed ({self.rate:,.0f} rows/s)"
+        )
+
+
+class BulkUploader:
+    """Sends batches of rows from a bounded thread pool, one HTTP session per thread."""
+
+    def __init__(self, outbox, url=GSHEET_URL, sheet="Track", workers=4, timeout=30, retries=3, backoff=1.0):
+        self.outbox = outbox
+        self.url = url
+        self.sheet = sheet
+        self.workers = workers
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._local = threading.local()
+
+    def upload(self, rows, stats, batch_size=50, progress=None):
+        """Queues and sends all rows, at most two batches per worker in flight."""
+        in_flight = set()
+        started = time.time()
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="bulk-upload") as executor:
+            for batch in batched(((row_key(row), row) for row in rows), batch_size):
+                unsent = self.outbox.add_unsent(batch, retry_before=started)
+                stats.skipped += len(batch) - len(unsent)
+                if not unsent:
+                    continue
+                # Backpressure: don't read further ahead than the pool can send
+                while len(in_flight) >= 2 * self.workers:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    self._count(done, stats, progress)
+                in_flight.add(executor.submit(self._send, unsent))
+            self._count(wait(in_flight).done, stats, progress)
+
+    def _count(self, futures, stats, progress):
+        for future in futures:
+            sent, failed = future.result()
+            stats.sent += sent
+            stats.failed += failed
+        if progress is not None:
+            progress(stats)
+
+    def _send(self, batch):
+        if not hasattr(self._local, "session"):
+            self._local.session = new_session()
+        import requests  # For the exception type, new_session() already loaded it
+
+        keys = [key for key, _ in batch]
+        rows = [dict(row, Key=key) for key, row in batch]
+        for attempt in range(self.retries):
+            try:
+                post_rows(self._local.session, rows, self.url, self.sheet, self.timeout)
+            except requests.RequestException as error:
+                print(f"Upload of {len(batch)} rows failed ({error})", file=sys.stderr)
+                if attempt + 1 < self.retries:
+                    time.sleep(self.backoff * 2**attempt)
+            else:
+                self.outbox.mark_sent(keys)
+                return len(batch), 0
+        self.outbox.mark_failed(keys)
+        return 0, len(batch)
+
+
+def import_files(paths, outbox, url=GSHEET_URL, workers=4, batch_size=50, progress=None, backoff=1.0):
+    """Imports and uploads results files, returns the ImportStats."""
+    stats = ImportStats()
+    rows = (row for path in paths for row in normalize_rows(read_records(path), stats, path))
+    BulkUploader(outbox, url, workers=workers, backoff=backoff).upload(rows, stats, batch_size, progress)
+    return stats
+
+
+def export_rows(outbox, path):
+    """Writes every row in the outbox to a CSV or JSON lines file, returns the count."""
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        if is_jsonl(path):
+            for row in outbox.rows():
+                columns = COLUMNS + tuple(column for column in OPTIONAL_COLUMNS if column in row)
+                file.write(json.dumps({column: row[column] for column in columns}) + "\n")
+                count += 1
+        else:
+            writer = csv.DictWriter(file, COLUMNS + OPTIONAL_COLUMNS, extrasaction="ignore")
+            writer.writeheader()
+            for row in outbox.rows():
+                writer.writerow(row)
+                count += 1
+    return count
+
+
+def main():
+    # Same outbox as the booth app when run from the same folder
+    default_outbox = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), "outbox.sqlite3")
+
+    parser = argparse.ArgumentParser(description="Bulk upload race results to the leaderboard sheet, or export them.")
+    parser.add_argument("--outbox", default=default_outbox, help="upload queue, default: the app's")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = commands.add_parser("import", help="upload results from CSV or JSON lines files")
+    import_parser.add_argument("files", nargs="+", help=".csv or .jsonl files")
+    import_parser.add_argument("--workers", type=int, default=4, help="concurrent requests")
+    import_parser.add_argument("--batch-size", type=int, default=50, help="rows per request")
+    import_parser.add_argument("--url", default=GSHEET_URL, help="Apps Script endpoint")
+    import_parser.add_argument("--check", action="store_true", help="only validate the files, upload nothing")
+
+    export_parser = commands.add_parser("export", help="write all results in the outbox to a file")
+    export_parser.add_argument("file", help=".csv or .jsonl file")
+
+    args = parser.parse_args()
+
+    if args.command == "export":
+        count = export_rows(Outbox(args.outbox), args.file)
+        print(f"Exported {count:,} rows to {args.file}")
+        return
+
+    if args.check:
+        stats = ImportStats()
+        for path in args.files:
+            for _ in normalize_rows(read_records(path), stats, path):
+                pass
+        print(f"{stats.read:,} rows read, {stats.invalid:,} invalid")
+        return
+
+    last_report = 0.0
+
+    def progress(stats):
+        nonlocal last_report
+        if time.perf_counter() - last_report >= 1:
+            last_report = time.perf_counter()
+            print(stats, file=sys.stderr)
+
+    stats = import_files(args.files, Outbox(args.outbox), args.url, args.workers, args.batch_size, progress)
+    print(stats)
+    if stats.failed:
+        print(f"{stats.failed:,} rows couldn't be sent, they stay queued in {args.outbox}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
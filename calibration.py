@@ -0,0 +1,274 @@
+"""Light level calibration from the sample stream, in constant memory."""
+
+import math
+import time
+
+# Interquartile range of a normal distribution, in standard deviations
+_IQR_PER_SIGMA = 1.349
+
+
+class P2Quantile:
+    """Streaming estimate of a single quantile (Jain & Chlamtac's P-square algorithm).
+
+    Keeps five markers instead of the samples, so memory stays constant no
+    matter how long it runs.
+    """
+
+    def __init__(self, quantile):
+        self.quantile = quantile
+        self.count = 0
+        self._heights = []
+        self._positions = [1, 2, 3, 4, 5]
+        self._desired = [1, 1 + 2 * quantile, 1 + 4 * quantile, 3 + 2 * quantile, 5]
+        self._increments = [0, quantile / 2, quantile, (1 + quantile) / 2, 1]
+
+    def add(self, value):
+        self.count += 1
+        heights = self._heights
+        if self.count <= 5:
+            heights.append(value)
+            heights.sort()
+            return
+
+        # Find the cell the value falls in, stretching the outer markers if needed
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = 0
+            while value >= heights[cell + 1]:
+                cell += 1
+
+        positions, desired = self._positions, self._desired
+        for i in range(cell + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            desired[i] += self._increments[i]
+
+        # Move the middle markers towards their desired positions
+        for i in range(1, 4):
+            offset = desired[i] - positions[i]
+            if (offset >= 1 and positions[i + 1] - positions[i] > 1) or (
+                offset <= -1 and positions[i - 1] - positions[i] < -1
+            ):
+                step = 1 if offset > 0 else -1
+                height = self._parabolic(i, step)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = self._linear(i, step)
+                heights[i] = height
+                positions[i] += step
+
+    def _parabolic(self, i, step):
+        q, n = self._heights, self._positions
+        return q[i] + step / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + step) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - step) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def _linear(self, i, step):
+        q, n = self._heights, self._positions
+        return q[i] + step * (q[i + step] - q[i]) / (n[i + step] - n[i])
+
+    @property
+    def value(self):
+        if self.count == 0:
+            return math.nan
+        if self.count <= 5:
+            # Too few samples for the markers, use the exact quantile
+            return self._heights[min(int(self.quantile * self.count), self.count - 1)]
+        return self._heights[2]
+
+
+class LevelEstimate:
+    """Median, quartiles, mean and variance of a light level, all streamed."""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self._lower = P2Quantile(0.25)
+        self._median = P2Quantile(0.5)
+        self._upper = P2Quantile(0.75)
+
+    def add_all(self, values):
+        for value in values:
+            # Welford's update
+            self.count += 1
+            delta = value - self.mean
+            self.mean += delta / self.count
+            self._m2 += delta * (value - self.mean)
+
+            self._lower.add(value)
+            self._median.add(value)
+            self._upper.add(value)
+        if values:
+            self.minimum = min(self.minimum, min(values))
+            self.maximum = max(self.maximum, max(values))
+
+    @property
+    def median(self):
+        return self._median.value
+
+    @property
+    def variance(self):
+        return self._m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def noise(self):
+        """Robust standard deviation from the interquartile range.
+
+        Unlike the plain variance this isn't thrown off by a hand briefly
+        waving past the sensor during the measurement.
+        """
+        if self.count < 2:
+            return 0.0
+        return (self._upper.value - self._lower.value) / _IQR_PER_SIGMA
+
+
+class Calibration:
+    """Bright/dim levels and the lap detection thresholds derived from them."""
+
+    def __init__(
+        self,
+        bright_level,
+        dim_level,
+        bright_noise=0.0,
+        dim_noise=0.0,
+        noise_sigmas=5.0,
+        min_margin=0.05,
+        max_margin=0.4,
+    ):
+        self.bright_level = bright_level
+        self.dim_level = dim_level
+        self.bright_noise = bright_noise
+        self.dim_noise = dim_noise
+        self.noise_sigmas = noise_sigmas
+        self.min_margin = min_margin
+        self.max_margin = max_margin
+
+        # Keep the thresholds noise_sigmas away from the middle, within
+        # min_margin..max_margin of the bright/dim span
+        span = abs(bright_level - dim_level)
+        margin = noise_sigmas * max(bright_noise, dim_noise)
+        self.noise_margin = min(max(margin, min_margin * span), max_margin * span)
+
+    @property
+    def shadow_threshold(self):
+        return (self.bright_level + self.dim_level) / 2
+
+    @property
+    def enter_threshold(self):
+        return self.shadow_threshold - self.noise_margin
+
+    @property
+    def exit_threshold(self):
+        return self.shadow_threshold + self.noise_margin
+
+    def with_bright_level(self, bright_level):
+        return Calibration(
+            bright_level,
+            self.dim_level,
+            self.bright_noise,
+            self.dim_noise,
+            self.noise_sigmas,
+            self.min_margin,
+            self.max_margin,
+        )
+
+    def __str__(self):
+        return (
+            f"Bright level: {self.bright_level:.0f} ± {self.bright_noise:.1f}, "
+            f"dim level: {self.dim_level:.0f} ± {self.dim_noise:.1f}, "
+            f"shadow threshold: {self.shadow_threshold:.0f} ± {self.noise_margin:.0f}"
+        )
+
+
+class CalibrationRun:
+    """Steps of the calibration procedure, advanced by the caller's clock.
+
+    Nothing in here blocks: the UI feeds it samples and calls update()
+    periodically, e.g. from Tk's after().
+    """
+
+    STEPS = (
+        ("Clear sensor please", None, 3),
+        ("Measuring...", "bright", 2),
+        ("Cover sensor please", None, 3),
+        ("Measuring...", "dim", 2),
+    )
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.levels = {"bright": LevelEstimate(), "dim": LevelEstimate()}
+        self._step = 0
+        self._step_started = clock()
+
+    @property
+    def prompt(self):
+        """Text to show the operator, None once the procedure is finished."""
+        if self._step >= len(self.STEPS):
+            return None
+        return self.STEPS[self._step][0]
+
+    def feed(self, values):
+        """Samples outside of a measuring step (moving hands etc.) are ignored."""
+        if self._step < len(self.STEPS):
+            level = self.STEPS[self._step][1]
+            if level is not None:
+                self.levels[level].add_all(values)
+
+    def update(self):
+        """Moves on to the next step when the current one is over, returns the prompt."""
+        now = self.clock()
+        while self._step < len(self.STEPS) and now - self._step_started >= self.STEPS[self._step][2]:
+            self._step_started += self.STEPS[self._step][2]
+            self._step += 1
+        return self.prompt
+
+    def result(self):
+        bright, dim = self.levels["bright"], self.levels["dim"]
+        if bright.count == 0 or dim.count == 0:
+            raise ValueError("No samples received from the sensor during calibration")
+        return Calibration(bright.median, dim.median, bright.noise, dim.noise)
+
+
+class AmbientTracker:
+    """Follows slow drift of the bright level (e.g. daylight) between races.
+
+    Samples are collected in windows of window_time seconds. A window only
+    counts when it is clean, i.e. nothing came close to casting a shadow;
+    its median is then blended into the bright level. Only every stride-th
+    sample goes into the median, which is plenty for a slow drift.
+    """
+
+    def __init__(self, window_time=5.0, weight=0.3, stride=10, clock=time.monotonic):
+        self.window_time = window_time
+        self.weight = weight
+        self.stride = stride
+        self.clock = clock
+        self._start_window()
+
+    def _start_window(self):
+        self._window = LevelEstimate()
+        self._window_minimum = math.inf
+        self._window_started = self.clock()
+
+    def feed(self, calibration, values):
+        """Returns an updated Calibration when a clean window completes, else None."""
+        if values:
+            self._window.add_all(values[:: self.stride])
+            self._window_minimum = min(self._window_minimum, min(values))
+        if self.clock() - self._window_started < self.window_time:
+            return None
+
+        window, minimum = self._window, self._window_minimum
+        self._start_window()
+        if window.count == 0 or minimum <= calibration.exit_threshold:
+            return None
+        bright_level = (1 - self.weight) * calibration.bright_level + self.weight * window.median
+        return calibration.with_bright_level(bright_level)
@@ -0,0 +1,193 @@
+"""Several tracks side by side, each with its own Arduino, driven from one process."""
+
+from collections import namedtuple
+import os
+import threading
+import time
+
+from calibration import AmbientTracker, Calibration
+from lap_detector import LapDetector, RaceTimer
+from metrics import METRICS
+from sample_buffer import AcquisitionThread, SampleRingBuffer
+from sensor_protocol import IDLE_MODE, RACE_MODE, SampleReader, new_sample_arrays
+
+
+# What the UI shows for a lane. The race loop replaces the whole tuple when
+# something changes, so readers on other threads always see a consistent state.
+# `started` is a time.monotonic() timestamp: when the countdown started in the
+# "countdown" phase, when the first lap was crossed in the "racing" phase.
+RaceState = namedtuple("RaceState", "phase started lap_count elapsed_time")
+IDLE = RaceState("idle", 0.0, 0, None)
+
+
+def is_arduino(port):
+    return (
+        "Arduino" in port.description
+        or "usbmodem" in port.device
+        or "usbserial" in port.device
+    )
+
+
+def find_arduinos():
+    """Detects all connected Arduinos and returns their port names, in a stable order.
+
+    RACETRACK_PORTS (comma-separated) overrides the detection, e.g. to point
+    the app at the virtual ports of simulator.py.
+    """
+    if os.environ.get("RACETRACK_PORTS"):
+        return [device.strip() for device in os.environ["RACETRACK_PORTS"].split(",") if device.strip()]
+
+    import serial.tools.list_ports  # Slow to import, only needed once the UI is up
+
+    devices = sorted(port.device for port in serial.tools.list_ports.comports() if is_arduino(port))
+
+    for device in devices:
+        print(f"Arduino found on {device}")
+    if not devices:
+        print("No Arduino detected. Check your connections.")
+    return devices
+
+
+class Lane:
+    """One track: its serial port, acquisition thread, sample buffer and calibration.
+
+    Only one party consumes a lane's samples at a time, recorded in `owner`:
+    "ambient" (tracking the light level between races), "calibration" or
+    "race".
+    """
+
+    def __init__(self, track, port):
+        self.track = track
+        self.port = port
+        self.sensor = SampleReader(port)
+        self.samples = SampleRingBuffer()
+        self.acquisition_thread = AcquisitionThread(self.sensor, self.samples)
+
+        self.calibration = Calibration(bright_level=600, dim_level=100)
+        self.ambient_tracker = AmbientTracker()
+        self.owner = "ambient"
+
+        self.running = False
+        self.racer = None
+        self.state = IDLE
+
+    def __str__(self):
+        return f"Track {self.track}"
+
+    def start(self, negotiate=True):
+        if negotiate and self.sensor.negotiate():
+            self.sensor.set_mode(IDLE_MODE)  # Until a race or calibration needs full rate
+        self.acquisition_thread.start()
+
+    def stop(self):
+        self.running = False
+        self.acquisition_thread.stop()
+
+
+class LaneSession:
+    """All lanes of the booth, numbered as tracks 1..n in port order."""
+
+    def __init__(self, lanes):
+        self.lanes = lanes
+
+    @classmethod
+    def open(cls, devices, baud_rate=115200):
+        import serial
+
+        lanes = [
+            Lane(track, serial.Serial(device, baud_rate, timeout=1))
+            for track, device in enumerate(devices, start=1)
+        ]
+        session = cls(lanes)
+        session.start()
+        return session
+
+    def start(self, negotiate=True):
+        # Protocol negotiation waits for the firmware, do all lanes at once
+        starters = [
+            threading.Thread(target=lane.start, args=(negotiate,), daemon=True)
+            for lane in self.lanes
+        ]
+        for starter in starters:
+            starter.start()
+        for starter in starters:
+            starter.join()
+
+    def lane(self, track):
+        return self.lanes[track - 1]
+
+    def tracks(self):
+        return [lane.track for lane in self.lanes]
+
+    def close(self):
+        for lane in self.lanes:
+            lane.stop()
+
+
+class RaceRun:
+    """One race on a lane, advanced one pass over the buffered samples at a time.
+
+    Publishes lane.state as the race goes. Nothing in here touches the UI or
+    blocks: run_race() drives it from a thread, the race engine from its
+    event loop, and the simulator benchmarks call either.
+    """
+
+    def __init__(self, lane, number_laps=7, debounce_time=0.5, recorder=None):
+        lane.samples.discard()  # Clear any previous data in buffer
+        self.lane = lane
+        self.recorder = recorder
+        self.timer = RaceTimer(
+            LapDetector(
+                lane.calibration.enter_threshold,
+                lane.calibration.exit_threshold,
+                debounce_time=debounce_time,
+            ),
+            number_laps,
+        )
+        self._samples = new_sample_arrays()
+        self._detection_latency = METRICS.histogram("detection")
+
+    def step(self):
+        """Processes everything the acquisition thread buffered since the last pass."""
+        lane, timer = self.lane, self.timer
+        times, values = self._samples
+        del times[:], values[:]
+        lane.samples.read(times, values)
+        if self.recorder is not None:
+            self.recorder.write(times, values)
+
+        crossings = timer.process(times, values)
+        if crossings:
+            # Time since the newest sample arrived, plus how much earlier
+            # (on the sample clock) the crossing happened
+            self._detection_latency.record(
+                time.monotonic() - lane.samples.last_write_time + times[-1] - crossings[-1]
+            )
+        for crossing in crossings:
+            print(f"{lane}: lap count switch to: {timer.lap_count}, time: {(crossing - timer.race_start):.2f}")
+
+        # Publish a new state for the render loop, only when something changed
+        if timer.finished:
+            print(f"{lane} sample buffer: {lane.samples.stats()}")
+            lane.state = RaceState("finished", lane.state.started, timer.lap_count, timer.elapsed_time)
+            lane.running = False
+        elif crossings:
+            started = lane.state.started if lane.state.phase == "racing" else time.monotonic()
+            lane.state = RaceState("racing", started, timer.lap_count, None)
+
+
+def run_race(lane, number_laps=7, debounce_time=0.5, recorder=None):
+    """Times a race on this lane until it's finished or lane.running is cleared.
+
+    Blocks the calling thread and returns the RaceTimer, see RaceRun. The
+    sensor runs at full rate for the race, and drops back to idle after.
+    """
+    lane.sensor.set_mode(RACE_MODE)
+    try:
+        race = RaceRun(lane, number_laps, debounce_time, recorder)
+        while lane.running:
+            race.step()
+            lane.samples.wait(0.05)
+        return race.timer
+    finally:
+        lane.sensor.set_mode(IDLE_MODE)
@@ -0,0 +1,147 @@
+"""Lap detection over blocks of timestamped light samples."""
+
+from race_result import RaceResult
+
+
+# Samples are scanned in chunks of this size; a chunk whose min/max shows it
+# can't contain a crossing is skipped without looking at individual samples
+_CHUNK = 64
+
+
+class LapDetector:
+    """Finds bright-to-dim crossings (a car's shadow) in a stream of samples.
+
+    Uses hysteresis: a crossing is registered when the light drops to
+    enter_threshold or below, and the detector only re-arms once the light is
+    back at exit_threshold or above, so noise around a single threshold can't
+    produce double counts. Crossing times come from the sample timestamps and
+    are interpolated between the two samples around the threshold. Crossings
+    within debounce_time of the previous lap are ignored.
+
+    A fresh detector starts disarmed: a shadow already on the sensor when
+    it starts, e.g. the car still parked on the line after the last race,
+    only counts once the light has been back at exit_threshold.
+    """
+
+    def __init__(self, enter_threshold, exit_threshold, debounce_time=0.5):
+        if enter_threshold > exit_threshold:
+            raise ValueError("enter_threshold must not be above exit_threshold")
+        self.enter_threshold = enter_threshold
+        self.exit_threshold = exit_threshold
+        self.debounce_time = debounce_time
+        self.reset()
+
+    @classmethod
+    def from_levels(cls, bright_level, dim_level, hysteresis=0.1, debounce_time=0.5):
+        """Thresholds around the midpoint, `hysteresis` of the bright/dim span apart."""
+        middle = (bright_level + dim_level) / 2
+        margin = abs(bright_level - dim_level) * hysteresis / 2
+        return cls(middle - margin, middle + margin, debounce_time)
+
+    def reset(self):
+        self.dim = True  # Armed by the first bright sample
+        self.last_lap_time = None
+        self._last_time = None
+        self._last_value = None
+
+    def process(self, times, values):
+        """Returns the interpolated crossing times of all laps in this block."""
+        count = len(values)
+        if count == 0:
+            return []
+
+        crossings = []
+        position = 0
+        while position < count:
+            end = min(position + _CHUNK, count)
+            chunk = values[position:end]
+            # Nothing can change state in this chunk, skip it in C
+            if (not self.dim and min(chunk) > self.enter_threshold) or (
+                self.dim and max(chunk) < self.exit_threshold
+            ):
+                position = end
+                continue
+
+            for index in range(position, end):
+                value = values[index]
+                if self.dim:
+                    if value >= self.exit_threshold:
+                        self.dim = False
+                elif value <= self.enter_threshold:
+                    self.dim = True
+                    crossing = self._crossing_time(times, values, index)
+                    if (
+                        self.last_lap_time is None
+                        or crossing - self.last_lap_time >= self.debounce_time
+                    ):
+                        crossings.append(crossing)
+                        self.last_lap_time = crossing
+            position = end
+
+        self._last_time = times[count - 1]
+        self._last_value = values[count - 1]
+        return crossings
+
+    def _crossing_time(self, times, values, index):
+        # Linear interpolation between the last bright sample and this one
+        if index > 0:
+            before_time, before_value = times[index - 1], values[index - 1]
+        elif self._last_time is not None:
+            before_time, before_value = self._last_time, self._last_value
+        else:
+            return times[index]
+
+        drop = before_value - values[index]
+        if drop <= 0:
+            return times[index]
+        fraction = (before_value - self.enter_threshold) / drop
+        return before_time + min(max(fraction, 0.0), 1.0) * (times[index] - before_time)
+
+
+def detect_laps(times, values, enter_threshold, exit_threshold, debounce_time=0.5):
+    """Runs a fresh detector over a whole recorded trace, e.g. for offline analysis."""
+    return LapDetector(enter_threshold, exit_threshold, debounce_time).process(
+        times, values
+    )
+
+
+class RaceTimer:
+    """Turns lap crossings into a race: the first crossing starts the clock.
+
+    The race is finished after number_laps full laps, i.e. on crossing
+    number_laps + 1. Shared by the live race loop and trace replays so both
+    time a race the same way.
+    """
+
+    def __init__(self, detector, number_laps):
+        self.detector = detector
+        self.number_laps = number_laps
+        self.lap_count = 0
+        self.race_start = None
+        self.elapsed_time = None
+        self.result = RaceResult()  # Every counted crossing, the start included
+
+    @property
+    def crossings(self):
+        return self.result.crossings
+
+    @property
+    def finished(self):
+        return self.elapsed_time is not None
+
+    def process(self, times, values):
+        """Returns the crossings in this block that counted towards the race."""
+        if self.finished:
+            return []
+
+        counted = []
+        for crossing in self.detector.process(times, values):
+            if self.race_start is None:
+                self.race_start = crossing
+            self.lap_count += 1
+            counted.append(crossing)
+            self.result.add(crossing)
+            if self.lap_count >= self.number_laps + 1:
+                self.elapsed_time = crossing - self.race_start
+                break
+        return counted
@@ -0,0 +1,119 @@
+"""Local leaderboard, so the booth can show standings without a network round-trip."""
+
+from bisect import bisect_left, insort
+import sqlite3
+import threading
+import time
+
+from race_result import split_statistics
+
+
+def today():
+    return time.strftime("%Y-%m-%d", time.localtime())
+
+
+class Leaderboard:
+    """Results stored in SQLite, with rankings kept in memory as sorted lists.
+
+    There is one sorted list of (elapsed_time, id, name) per track and day and
+    one per track for all time. A new result is inserted at its place with
+    bisect, so ranks and top-N lists never need a full re-sort. Each result
+    can carry its race's lap crossings (RaceResult.to_bytes()) for split
+    analysis.
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS results (
+                id INTEGER PRIMARY KEY,
+                track INTEGER NOT NULL,
+                day TEXT NOT NULL,
+                name TEXT NOT NULL,
+                email TEXT NOT NULL,
+                elapsed_time REAL NOT NULL,
+                recorded REAL NOT NULL,
+                crossings BLOB
+            )"""
+        )
+        # Stores created before lap crossings were kept
+        columns = [column[1] for column in self._db.execute("PRAGMA table_info(results)")]
+        if "crossings" not in columns:
+            self._db.execute("ALTER TABLE results ADD COLUMN crossings BLOB")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS results_ranking ON results (track, day, elapsed_time)"
+        )
+        self._db.commit()
+
+        self._standings = {}  # (track, day or None) -> sorted [(elapsed_time, id, name)]
+        self._personal_bests = {}  # (track, email) -> elapsed_time
+        self._load()
+
+    def _load(self):
+        # The index hands the rows over already sorted, so plain appends suffice
+        # per (track, day); the all-time lists get a single sort at the end
+        rows = self._db.execute(
+            "SELECT id, track, day, name, email, elapsed_time FROM results "
+            "ORDER BY track, day, elapsed_time"
+        )
+        for result_id, track, day, name, email, elapsed_time in rows:
+            entry = (elapsed_time, result_id, name)
+            self._standings.setdefault((track, day), []).append(entry)
+            self._standings.setdefault((track, None), []).append(entry)
+            self._update_personal_best(track, email, elapsed_time)
+        for (track, day), entries in self._standings.items():
+            if day is None:
+                entries.sort()
+
+    def _update_personal_best(self, track, email, elapsed_time):
+        key = (track, email.lower())
+        best = self._personal_bests.get(key)
+        if best is None or elapsed_time < best:
+            self._personal_bests[key] = elapsed_time
+
+    def add(self, name, email, track, elapsed_time, day=None, race_result=None):
+        """Stores a result, with its RaceResult if there is one, and returns its rank for that day."""
+        day = day or today()
+        crossings = race_result.to_bytes() if race_result is not None else None
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO results (track, day, name, email, elapsed_time, recorded, crossings) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (track, day, name, email, elapsed_time, time.time(), crossings),
+            )
+            self._db.commit()
+            entry = (elapsed_time, cursor.lastrowid, name)
+            insort(self._standings.setdefault((track, day), []), entry)
+            insort(self._standings.setdefault((track, None), []), entry)
+            self._update_personal_best(track, email, elapsed_time)
+            return self.rank(track, elapsed_time, day)
+
+    def rank(self, track, elapsed_time, day=None):
+        """1-based position elapsed_time has (or would have) on that day, or all time with day=None."""
+        standings = self._standings.get((track, day), ())
+        return bisect_left(standings, (elapsed_time,)) + 1
+
+    def top(self, track, count=10, day=None):
+        """The fastest (name, elapsed_time) pairs on that day, or all time with day=None."""
+        standings = self._standings.get((track, day), ())
+        return [(name, elapsed_time) for elapsed_time, _, name in standings[:count]]
+
+    def personal_best(self, track, email):
+        return self._personal_bests.get((track, email.lower()))
+
+    def split_statistics(self, track, day=None, percentiles=(10, 50, 90)):
+        """Lap time statistics of the track's stored races, see race_result.split_statistics()."""
+        query = "SELECT crossings FROM results WHERE track = ? AND crossings IS NOT NULL"
+        parameters = (track,)
+        if day is not None:
+            query += " AND day = ?"
+            parameters += (day,)
+        with self._lock:
+            stored = [crossings for (crossings,) in self._db.execute(query, parameters)]
+        return split_statistics(stored, percentiles)
+
+    def __len__(self):
+        return sum(len(entries) for (_, day), entries in self._standings.items() if day is None)
@@ -0,0 +1,129 @@
+"""Latency histograms for the measurement hot path.
+
+Disabled unless the RACETRACK_METRICS environment variable is set to 1. When
+disabled, every histogram is a shared no-op, so instrumented code costs one
+method call. Enable it, then press F12 in the app for the debug overlay;
+the histograms are also dumped to metrics.json every few seconds.
+"""
+
+from array import array
+import json
+import os
+import threading
+import time
+
+# Histogram resolution: each power of two of microseconds is split into this
+# many linear sub-buckets, i.e. values are kept to within 1/_SUB_BUCKETS
+_SUB_BUCKETS = 16
+_SUB_BITS = 4
+_MAX_EXPONENT = 32  # Up to 2**32 us, more than an hour
+
+
+class Histogram:
+    """Fixed-size, HDR-style histogram of durations in seconds, stored as microseconds."""
+
+    enabled = True
+
+    def __init__(self, name):
+        self.name = name
+        self._counts = array("Q", bytes(8 * _SUB_BUCKETS * (_MAX_EXPONENT + 1)))
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def record(self, seconds):
+        microseconds = min(max(int(seconds * 1e6), 0), (1 << _MAX_EXPONENT) - 1)
+        self._counts[_bucket(microseconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.maximum:
+            self.maximum = seconds
+
+    def percentile(self, percent):
+        """Upper bound of the bucket the given percentile falls in, in seconds."""
+        if self.count == 0:
+            return 0.0
+        rank = max(1, round(self.count * percent / 100))
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if seen >= rank:
+                return min(_bucket_upper_bound(index) / 1e6, self.maximum)
+        return self.maximum
+
+    def summary(self):
+        """Counts and latencies in milliseconds."""
+        return {
+            "count": self.count,
+            "mean_ms": 1000 * self.total / self.count if self.count else 0.0,
+            "p50_ms": 1000 * self.percentile(50),
+            "p90_ms": 1000 * self.percentile(90),
+            "p99_ms": 1000 * self.percentile(99),
+            "max_ms": 1000 * self.maximum,
+        }
+
+
+def _bucket(microseconds):
+    if microseconds < _SUB_BUCKETS:
+        return microseconds
+    exponent = microseconds.bit_length() - _SUB_BITS
+    return (exponent << _SUB_BITS) + (microseconds >> (exponent - 1)) - _SUB_BUCKETS
+
+
+def _bucket_upper_bound(index):
+    if index < _SUB_BUCKETS:
+        return index + 1
+    exponent, sub_bucket = divmod(index, _SUB_BUCKETS)
+    return (sub_bucket + _SUB_BUCKETS + 1) << (exponent - 1)
+
+
+class _NullHistogram:
+    enabled = False
+
+    def record(self, seconds):
+        pass
+
+
+_NULL_HISTOGRAM = _NullHistogram()
+
+
+class Metrics:
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name):
+        """The histogram with this name, created on first use. Look it up once, outside the hot loop."""
+        if not self.enabled:
+            return _NULL_HISTOGRAM
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = Histogram(name)
+            return self._histograms[name]
+
+    def summary(self):
+        with self._lock:
+            histograms = list(self._histograms.values())
+        return {histogram.name: histogram.summary() for histogram in histograms}
+
+    def dump(self, path):
+        # Write to a temporary file first, so readers never see half a dump
+        with open(path + ".tmp", "w") as file:
+            json.dump({"time": time.time(), "histograms": self.summary()}, file, indent=2)
+        os.replace(path + ".tmp", path)
+
+    def start_dumping(self, path, interval=10.0):
+        """Dumps the histograms to path every interval seconds, from a background thread."""
+        if not self.enabled:
+            return
+
+        def dump_periodically():
+            while True:
+                time.sleep(interval)
+                self.dump(path)
+
+        threading.Thread(target=dump_periodically, name="metrics-dump", daemon=True).start()
+
+
+METRICS = Metrics(enabled=os.environ.get("RACETRACK_METRICS") == "1")
@@ -0,0 +1,368 @@
+"""The booth's race logic on one asyncio event loop, independent of any UI.
+
+Races, calibrations, ambient light tracking and saving results run as tasks
+on an event loop in a background thread. The UI sends commands, which go
+through a bounded queue, and subscribes to snapshots of every lane's state.
+Snapshots are immutable, so other threads can read them without locks, and
+a subscriber that falls behind skips to the newest one instead of queueing.
+
+Lane state is only ever changed on the engine's loop. The serial ports are
+still drained by each lane's acquisition thread, as pyserial only offers
+blocking reads; the tasks read from the lanes' lock-free sample buffers.
+Each lane has one task at a time (ambient light tracking, a calibration or
+a race), which sleeps until the acquisition thread wakes it with new
+samples, so an idle booth only wakes up when its sensors send something.
+"""
+
+import asyncio
+from collections import deque, namedtuple
+import functools
+import threading
+import time
+
+from calibration import CalibrationRun
+from lanes import IDLE, LaneSession, RaceRun, RaceState
+from leaderboard import today
+from sensor_protocol import IDLE_MODE, RACE_MODE, new_sample_arrays
+from traces import TraceWriter
+from uploader import make_row
+
+# One lane as the UI sees it. `prompt` is the calibration prompt while the
+# lane calibrates, then the outcome until the next calibration. `result`
+# (the RaceResult, with the laps), `rank` and `best` (today's fastest time)
+# are set once a race has finished.
+LaneView = namedtuple("LaneView", "track owner state racer prompt calibration result rank best")
+
+# Everything a subscriber gets. `ready` turns True once the tracks are connected,
+# `error` says why they couldn't be, in which case the engine has stopped.
+Snapshot = namedtuple("Snapshot", "sequence ready lanes error")
+
+
+class Subscription:
+    """Snapshots for one subscriber, at most `depth` of them pending.
+
+    The engine thread appends and the subscriber pops; a deque with maxlen
+    drops the oldest snapshot when full, so a slow subscriber never holds
+    up the engine.
+    """
+
+    def __init__(self, depth=1):
+        self._pending = deque(maxlen=depth)
+
+    def put(self, snapshot):
+        self._pending.append(snapshot)
+
+    def poll(self):
+        """The newest snapshot since the last poll, or None."""
+        latest = None
+        while self._pending:
+            latest = self._pending.popleft()
+        return latest
+
+
+class RaceEngine:
+    """Runs the booth on an asyncio loop, see the module docstring.
+
+    connect() is called once on start, off the loop, and returns the
+    (LaneSession, Leaderboard, Uploader) to use; the latter two may be
+    None, e.g. in benchmarks. The command methods can be called from any
+    thread.
+    """
+
+    def __init__(
+        self,
+        connect,
+        number_laps=7,
+        debounce_time=0.5,
+        trace_directory=None,
+        queue_size=16,
+    ):
+        self.connect = connect
+        self.number_laps = number_laps
+        self.debounce_time = debounce_time
+        self.trace_directory = trace_directory
+
+        self.session = LaneSession([])
+        self.leaderboard = None
+        self.uploader = None
+        self.ready = False
+        self.error = None
+
+        self._loop = asyncio.new_event_loop()
+        self._commands = asyncio.Queue(queue_size)
+        self._thread = threading.Thread(target=self._run, name="race-engine", daemon=True)
+        self._subscriptions = []
+        self._sequence = 0
+        self._prompts = {}  # track -> calibration prompt or outcome
+        self._finished = {}  # track -> (RaceResult, rank, best) of the finished race
+        self._lane_tasks = {}  # track -> the task using its samples: ambient tracking, calibration or race
+        self._arrived = {}  # track -> asyncio.Event, set when its acquisition thread buffered samples
+        self._saves = set()
+        self._stopping = False
+        self._main_task = None
+        self.snapshot = Snapshot(0, False, (), None)
+
+    # Commands, from any thread
+
+    def start(self):
+        self._main_task = self._loop.create_task(self._main())
+        self._thread.start()
+
+    def stop(self):
+        """Cancels everything still running and closes the lanes."""
+        if self._thread.is_alive():
+            # Not through the command queue, which drops commands when it's full
+            try:
+                self._loop.call_soon_threadsafe(self._main_task.cancel)
+            except RuntimeError:
+                pass  # The loop already ended on its own
+            self._thread.join()
+        self.session.close()
+
+    def start_race(self, track, name, email):
+        self._submit("race", track, (name, email))
+
+    def calibrate(self, track):
+        self._submit("calibrate", track)
+
+    def save_result(self, track):
+        """Stores the finished race's result and queues it for upload, then frees the lane."""
+        self._submit("save", track)
+
+    def release(self, track):
+        """Stops whatever runs on the lane and frees it, without saving anything."""
+        self._submit("release", track)
+
+    def subscribe(self, depth=1):
+        subscription = Subscription(depth)
+        subscription.put(self.snapshot)
+        self._subscriptions.append(subscription)
+        return subscription
+
+    def _submit(self, *command):
+        try:
+            self._loop.call_soon_threadsafe(self._send, command)
+        except RuntimeError:
+            # The loop is closed, e.g. after connect() failed
+            print(f"Race engine not running, dropped command {command}")
+
+    def _send(self, command):
+        try:
+            self._commands.put_nowait(command)
+        except asyncio.QueueFull:
+            print(f"Race engine busy, dropped command {command}")
+
+    # The loop
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self._main_task)
+        except asyncio.CancelledError:
+            pass  # stop()
+        finally:
+            self._loop.close()
+
+    async def _main(self):
+        try:
+            self.session, self.leaderboard, self.uploader = await asyncio.to_thread(self.connect)
+        except Exception as error:
+            # E.g. a serial port in use or an unwritable data directory
+            self.error = f"{type(error).__name__}: {error}"
+            print(f"Race engine couldn't connect: {self.error}")
+            self._publish()
+            return
+        for lane in self.session.lanes:
+            arrived = self._arrived[lane.track] = asyncio.Event()
+            lane.samples.on_write = functools.partial(self._loop.call_soon_threadsafe, arrived.set)
+            self._lane_tasks[lane.track] = self._loop.create_task(self._track_ambient(lane))
+        self.ready = True
+        self._publish()
+
+        try:
+            while True:
+                name, track, *args = await self._commands.get()
+                handler = getattr(self, f"_on_{name}")
+                handler(self.session.lane(track), *args)
+        finally:
+            # Results being saved get to finish, everything else stops
+            self._stopping = True
+            tasks = list(self._lane_tasks.values())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, *self._saves, return_exceptions=True)
+            for lane in self.session.lanes:
+                lane.samples.on_write = None
+
+    def _publish(self):
+        """Hands every subscriber a fresh snapshot, call after any change."""
+        self._sequence += 1
+        self.snapshot = Snapshot(
+            self._sequence,
+            self.ready,
+            tuple(
+                LaneView(
+                    lane.track,
+                    lane.owner,
+                    lane.state,
+                    lane.racer,
+                    self._prompts.get(lane.track),
+                    lane.calibration,
+                    *self._finished.get(lane.track, (None, None, None)),
+                )
+                for lane in self.session.lanes
+            ),
+            self.error,
+        )
+        for subscription in self._subscriptions:
+            subscription.put(self.snapshot)
+
+    # Command handlers, on the loop. They check again what the UI already
+    # checked on its (possibly outdated) snapshot.
+
+    def _on_race(self, lane, racer):
+        if lane.owner != "ambient":
+            return
+        # The race takes over the lane's sample stream
+        self._lane_tasks[lane.track].cancel()
+        lane.owner = "race"
+        lane.racer = racer
+        lane.state = RaceState("countdown", time.monotonic(), 0, None)
+        self._lane_tasks[lane.track] = self._loop.create_task(self._race(lane))
+        self._publish()
+
+    def _on_calibrate(self, lane):
+        if lane.owner != "ambient":
+            return
+        self._lane_tasks[lane.track].cancel()
+        lane.owner = "calibration"
+        self._lane_tasks[lane.track] = self._loop.create_task(self._calibrate(lane))
+        self._publish()
+
+    def _on_save(self, lane):
+        if lane.owner != "race" or lane.track not in self._finished:
+            return
+        name, email = lane.racer
+        race_result = self._finished[lane.track][0]
+        save = self._loop.create_task(self._save(name, email, lane.track, lane.state.elapsed_time, race_result))
+        self._saves.add(save)
+        save.add_done_callback(self._saves.discard)
+        self._release(lane)
+
+    def _on_release(self, lane):
+        if lane.owner != "ambient":
+            self._release(lane)
+
+    def _release(self, lane):
+        """Hands the lane's sample stream back to the ambient light tracking."""
+        task = self._lane_tasks.pop(lane.track, None)
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+        lane.running = False
+        lane.sensor.set_mode(IDLE_MODE)
+        lane.samples.discard()
+        lane.owner = "ambient"
+        lane.racer = None
+        lane.state = IDLE
+        self._finished.pop(lane.track, None)
+        if not self._stopping:
+            self._lane_tasks[lane.track] = self._loop.create_task(self._track_ambient(lane))
+        self._publish()
+
+    async def _samples(self, lane, timeout=None):
+        """Until the lane's acquisition thread has buffered samples (or timeout), unless some are pending."""
+        arrived = self._arrived[lane.track]
+        arrived.clear()
+        if not len(lane.samples):
+            try:
+                await asyncio.wait_for(arrived.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    # Tasks
+
+    async def _race(self, lane):
+        recorder = None
+        if self.trace_directory is not None:
+            recorder = TraceWriter.for_race(self.trace_directory, lane.track, lane.calibration)
+        lane.sensor.set_mode(RACE_MODE)
+        race = RaceRun(lane, self.number_laps, self.debounce_time, recorder)
+        lane.running = True
+        try:
+            state = lane.state
+            while True:
+                race.step()
+                if not lane.running:
+                    break  # Finished, published below once the result is stored
+                if lane.state is not state:
+                    state = lane.state
+                    self._publish()
+                await self._samples(lane)
+        finally:
+            lane.running = False
+            if recorder is not None:
+                recorder.close()
+
+        timer = race.timer
+        if timer.finished:
+            lane.sensor.set_mode(IDLE_MODE)  # Until the result is saved or discarded
+            rank = best = None
+            if self.leaderboard is not None:
+                rank = self.leaderboard.rank(lane.track, timer.elapsed_time, today())
+                top = self.leaderboard.top(lane.track, count=1, day=today())
+                best = top[0][1] if top else None
+            self._finished[lane.track] = (timer.result, rank, best)
+            self._publish()
+
+    async def _calibrate(self, lane):
+        # At the full sample rate, fed from the lane's stream until it's done
+        lane.sensor.set_mode(RACE_MODE)
+        lane.samples.discard()
+        calibration_run = CalibrationRun()
+        times, values = new_sample_arrays()
+        try:
+            while (prompt := calibration_run.update()) is not None:
+                if self._prompts.get(lane.track) != prompt:
+                    self._prompts[lane.track] = prompt
+                    self._publish()
+                # The prompts also move on with time, without samples
+                await self._samples(lane, timeout=0.1)
+                del times[:], values[:]
+                lane.samples.read(times, values)
+                calibration_run.feed(values)
+
+            try:
+                lane.calibration = calibration_run.result()
+            except ValueError as error:
+                print(error)
+                self._prompts[lane.track] = "Calibration failed,\nno sensor data"
+            else:
+                print(f"{lane}: {lane.calibration}")
+                self._prompts[lane.track] = "Calibration complete!"
+        finally:
+            self._release(lane)
+
+    async def _track_ambient(self, lane):
+        """Between races, keeps the bright level in line with slow changes in ambient light."""
+        times, values = new_sample_arrays()
+        while True:
+            await self._samples(lane)
+            del times[:], values[:]
+            lane.samples.read(times, values)
+
+            calibration = lane.ambient_tracker.feed(lane.calibration, values)
+            if calibration is not None:
+                lane.calibration = calibration
+
+    async def _save(self, name, email, track, elapsed_time, race_result):
+        # SQLite commits block, keep them off the loop
+        if self.leaderboard is not None:
+            await asyncio.to_thread(
+                self.leaderboard.add, name, email, track, elapsed_time, race_result=race_result
+            )
+        if self.uploader is not None:
+            # Queued on disk and uploaded in the background, so a slow or
+            # missing network connection doesn't hold up anything
+            row = make_row(name, email, track, elapsed_time, splits=race_result.splits)
+            await asyncio.to_thread(self.uploader.submit, row)
+        self._publish()  # For subscribers showing the leaderboard
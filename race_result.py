@@ -0,0 +1,123 @@
+"""Lap-by-lap record of a race, and split analysis over many stored races."""
+
+from array import array
+from operator import sub
+import sys
+
+
+class RaceResult:
+    """Every counted crossing of a race on the sample clock, the start included.
+
+    A lap's split is the time between two consecutive crossings. Crossings
+    are kept in an array of doubles, so a result is 8 bytes per crossing in
+    memory and in the local store, whatever the number of laps.
+    """
+
+    __slots__ = ("crossings",)
+
+    def __init__(self, crossings=()):
+        self.crossings = array("d", crossings)
+
+    def add(self, crossing):
+        self.crossings.append(crossing)
+
+    @property
+    def lap_count(self):
+        return max(len(self.crossings) - 1, 0)
+
+    @property
+    def elapsed_time(self):
+        """Time from the first to the last crossing, None before a full lap."""
+        if len(self.crossings) < 2:
+            return None
+        return self.crossings[-1] - self.crossings[0]
+
+    @property
+    def splits(self):
+        return splits(self.crossings)
+
+    @property
+    def best_lap(self):
+        return min(self.splits, default=None)
+
+    @property
+    def consistency(self):
+        """Standard deviation of the splits: 0 for a racer who laps like clockwork."""
+        laps = self.splits
+        if not laps:
+            return None
+        mean = sum(laps) / len(laps)
+        return (sum((lap - mean) ** 2 for lap in laps) / len(laps)) ** 0.5
+
+    def to_bytes(self):
+        """Compact little-endian form for the local store, see from_bytes()."""
+        if sys.byteorder == "big":
+            crossings = array("d", self.crossings)
+            crossings.byteswap()
+            return crossings.tobytes()
+        return self.crossings.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        result = cls()
+        result.crossings.frombytes(data)
+        if sys.byteorder == "big":
+            result.crossings.byteswap()
+        return result
+
+    def __repr__(self):
+        return f"RaceResult({list(self.crossings)!r})"
+
+
+def splits(crossings):
+    """Lap times between consecutive crossings, as an array."""
+    return array("d", map(sub, crossings[1:], crossings[:-1]))
+
+
+def format_splits(splits):
+    """Lap times as seconds with hundredths, space-separated, e.g. for the sheet's "Laps" column."""
+    return " ".join(f"{split:.2f}" for split in splits)
+
+
+def split_statistics(stored_results, percentiles=(10, 50, 90)):
+    """Lap time statistics over many races, from their RaceResult.to_bytes() forms.
+
+    The races' splits are gathered into one array and sorted once, instead
+    of building a RaceResult per race. Returns the number of races and
+    laps, the fastest lap overall, the fastest time per lap number (1 is
+    the first lap) and the requested percentiles of all lap times.
+    """
+    all_splits = array("d")
+    fastest_by_lap = []
+    races = 0
+    crossings = array("d")
+    for data in stored_results:
+        del crossings[:]
+        crossings.frombytes(data)
+        if sys.byteorder == "big":
+            crossings.byteswap()
+        race_splits = splits(crossings)
+        if not race_splits:
+            continue
+        races += 1
+        all_splits.extend(race_splits)
+        for lap, split in enumerate(race_splits):
+            if lap == len(fastest_by_lap):
+                fastest_by_lap.append(split)
+            elif split < fastest_by_lap[lap]:
+                fastest_by_lap[lap] = split
+
+    ordered = sorted(all_splits)
+    return {
+        "races": races,
+        "laps": len(ordered),
+        "fastest_lap": ordered[0] if ordered else None,
+        "fastest_by_lap": fastest_by_lap,
+        "percentiles": {percent: _percentile(ordered, percent) for percent in percentiles} if ordered else {},
+    }
+
+
+def _percentile(ordered, percent):
+    # Nearest rank, like metrics.Histogram
+    rank = max(1, round(len(ordered) * percent / 100))
+    return ordered[rank - 1]
@@ -1,31 +1,27 @@
 # Should be exported as a standalone executable
 # Can be done by running: pyinstaller --onefile --console --clean racetrack-counter-ui.py
 
-import requests
-import serial
-import serial.tools.list_ports
-import threading
 import time
+
+STARTED = time.perf_counter()  # For the time-to-first-frame measurement
+
+import os
+import sys
 import tkinter as tk
 from tkinter import messagebox
-import webbrowser
-
 
-def find_arduino():
-    """Detects the Arduino's COM port and returns the port name."""
-    ports = serial.tools.list_ports.comports()
+from lanes import LaneSession, find_arduinos
+from leaderboard import Leaderboard
+from metrics import METRICS
+from race_engine import RaceEngine
+from render_loop import RenderLoop
+from uploader import Outbox, Uploader
 
-    for port in ports:
-        if (
-            "Arduino" in port.description
-            or "usbmodem" in port.device
-            or "usbserial" in port.device
-        ):
-            print(f"Arduino found on {port.device}")
-            return port.device
 
-    print("No Arduino detected. Check your connections.")
-    return None
+def data_path(filename):
+    """Path for files that should survive restarts, next to the script or executable."""
+    # With pyinstaller --onefile, __file__ points into a temporary directory
+    return os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), filename)
 
 def center_window(window, window_width, window_height):
     # Center the window on the screen
@@ -36,28 +32,109 @@ def center_window(window, window_width, window_height):
     window.geometry(f"{window_width}x{window_height}+{position_right}+{position_top}")
 
 
+def connect(baud_rate=115200):
+    """Port detection, protocol negotiation and the network stack, run by the engine off the Tk thread."""
+    # Results that couldn't be uploaded yet are retried after a restart too
+    uploader = Uploader(Outbox(data_path("outbox.sqlite3")))
+    uploader.start()
+    leaderboard = Leaderboard(data_path("leaderboard.sqlite3"))
+
+    # Initialize Arduino connections, one lane per track
+    session = LaneSession.open(find_arduinos(), baud_rate)
+    return session, leaderboard, uploader
+
+
 class RacetrackUI:  # TODO (nice-to-have): Auto full screen / hide X button
     # TODO (nice-to-have): Add sound effects for countdown and lap detection
-    def __init__(self, baud_rate=115200):
+    """Widgets only: commands go to the RaceEngine, and what's shown comes from its snapshots."""
+
+    def __init__(self, engine):
         # Initialize UI
         self.root = tk.Tk()
         self.root.title("Racetrack timer UI")
         center_window(self.root, 800, 400)
 
-        # Initialize Arduino connection
-        arduino_port = find_arduino()
-        self.arduino = serial.Serial(arduino_port, baud_rate, timeout=1)
-        self.bright_level = 600
-        self.dim_level = 100
-        self.shadow_threshold = (self.dim_level + self.bright_level) / 2
-        self.number_laps = 7
         self.countdown_duration = 3
-        self.ui_update_period = 0.1
-        self.debounce_time = 0.5
+        self.frame_rate = 20
+        self.poll_interval = 50  # ms
+
+        # The engine connects to the tracks in the background once the
+        # main screen is showing, see first_frame()
+        self.engine = engine
+        self.subscription = engine.subscribe()
+        self.snapshot = engine.snapshot
+
+        self.calibrating_track = None
+        self.calib_window = None
+        self.race_window = None
+        self.race_labels = {}
+        self.render_loop = RenderLoop(self.root, self.render_race_view, fps=self.frame_rate)
+        self.result_windows = {}
+
+        # Latency metrics, only when enabled through RACETRACK_METRICS=1
+        self.debug_window = None
+        if METRICS.enabled:
+            METRICS.start_dumping(data_path("metrics.json"))
+            self.root.bind_all("<F12>", lambda e: self.toggle_debug_overlay())
+
+        # Live view for a big screen and phones, only when a port is set through RACETRACK_SPECTATOR_PORT
+        self.spectator_server = None
+        if os.environ.get("RACETRACK_SPECTATOR_PORT"):
+            from spectators import SpectatorServer
+
+            self.spectator_server = SpectatorServer(engine, port=int(os.environ["RACETRACK_SPECTATOR_PORT"]))
 
         self.create_main_screen()
+        self.root.after(0, self.first_frame)
 
+    def run(self):
         self.root.mainloop()
+        if self.spectator_server is not None:
+            self.spectator_server.stop()
+        self.engine.stop()
+
+    def first_frame(self):
+        first_frame_time = time.perf_counter() - STARTED
+        print(f"Main screen shown {first_frame_time * 1000:.0f} ms after start")
+        if os.environ.get("RACETRACK_EXIT_AFTER_FIRST_FRAME") == "1":
+            # Used by the startup benchmark
+            self.root.destroy()
+            return
+        self.engine.start()
+        if self.spectator_server is not None:
+            self.spectator_server.start()
+        self.root.after(self.poll_interval, self.poll_engine)
+
+    def poll_engine(self):
+        snapshot = self.subscription.poll()
+        if snapshot is not None:
+            self.update_from(snapshot)
+        self.root.after(self.poll_interval, self.poll_engine)
+
+    def update_from(self, snapshot):
+        """Opens and closes windows for whatever changed since the previous snapshot."""
+        previous, self.snapshot = self.snapshot, snapshot
+        if snapshot.ready and not previous.ready:
+            self.create_track_selector()
+        if snapshot.error is not None and previous.error is None:
+            messagebox.showerror("Racetrack not connected", f"Couldn't connect to the racetrack:\n{snapshot.error}")
+
+        before = {view.track: view for view in previous.lanes}
+        for view in snapshot.lanes:
+            old = before.get(view.track)
+            if view.owner == "calibration" and view.track == self.calibrating_track:
+                self.show_calibration_prompt(view)
+            elif old is not None and old.owner == "calibration":
+                self.finish_calibration(view)
+
+            if view.state.phase == "finished" and (old is None or old.state.phase != "finished"):
+                self.show_result_screen(view)
+
+        # Close the race view once no track is in use anymore
+        was_racing = any(view.owner == "race" for view in previous.lanes)
+        racing = any(view.owner == "race" for view in snapshot.lanes)
+        if self.race_window is not None and was_racing and not racing and not self.result_windows:
+            self.close_race_window()
 
     def create_main_screen(self):
         """Sets up the main screen widgets."""
@@ -107,12 +184,6 @@ class RacetrackUI:  # TODO (nice-to-have): Auto full screen / hide X button
             "<Button-1>", lambda e: self.open_privacy_statement()
         )
 
-        # self.track_label = tk.Label(self.root, text="Enter track name:", font=("Arial", 15))
-        # self.track_label.pack(pady=5)
-
-        # self.track_entry = tk.Entry(self.root, textvariable=self.track_var, font=("Arial", 15))
-        # self.track_entry.pack(pady=5)
-
         self.calibrate_button = tk.Button(
             self.root, text="Calibrate", command=self.calibrate, font=("Arial", 10)
         )
@@ -131,7 +202,20 @@ class RacetrackUI:  # TODO (nice-to-have): Auto full screen / hide X button
         )
         self.quit_button.pack(pady=10)
 
+    def create_track_selector(self):
+        # Only ask for the track when there's more than one to choose from
+        tracks = [view.track for view in self.snapshot.lanes]
+        self.track_var.set(str(tracks[0]) if tracks else "")
+        if len(tracks) > 1:
+            self.track_label = tk.Label(self.root, text="Track:", font=("Arial", 15))
+            self.track_label.pack(pady=5, before=self.start_button)
+
+            self.track_entry = tk.OptionMenu(self.root, self.track_var, *map(str, tracks))
+            self.track_entry.pack(pady=5, before=self.start_button)
+
     def open_privacy_statement(self):
+        import webbrowser  # Only needed here, keep it out of startup
+
         webbrowser.open("https://jobs.picnic.app/en/privacy-policy")
 
     def validate_inputs(self):
@@ -139,7 +223,7 @@ class RacetrackUI:  # TODO (nice-to-have): Auto full screen / hide X button
         name = self.name_var.get().strip()
         email = self.email_var.get().strip()
         consent = self.consent_var.get()
-        # track = self.track_var.get().strip()
+        track = self.track_var.get().strip()
 
         if not name:
             messagebox.showerror("Input Error", "Name cannot be empty.")
@@ -150,246 +234,217 @@ class RacetrackUI:  # TODO (nice-to-have): Auto full screen / hide X button
         if not consent:
             messagebox.showerror("Input Error", "Please check the consent box.")
             return
-        # if not track:
-        #     tk.messagebox.showerror("Input Error", "Track name cannot be empty.")
-        #     return
-        self.start_measurement()
+        if self.snapshot.error is not None:
+            messagebox.showerror("Racetrack not connected", f"Couldn't connect to the racetrack:\n{self.snapshot.error}")
+            return
+        if not self.snapshot.ready:
+            messagebox.showerror("Starting up", "Still connecting to the racetrack, please try again in a moment.")
+            return
+        if not track:
+            messagebox.showerror("Input Error", "No track connected.")
+            return
+        self.start_measurement(int(track), name, email)
+
+    def lane_view(self, track):
+        return self.snapshot.lanes[track - 1]
 
     def calibrate(self):
+        track = self.track_var.get()
+        if not track or self.calibrating_track is not None:
+            return
+        if self.lane_view(int(track)).owner != "ambient":
+            return
+        self.calibrating_track = int(track)
+        self.engine.calibrate(self.calibrating_track)
+
         self.calib_window = tk.Toplevel(self.root)
-        self.calib_window.title("Calibration")
+        self.calib_window.title(f"Calibration Track {track}")
         center_window(self.calib_window, 400, 200)
+        # Window closed halfway, keep the previous calibration
+        self.calib_window.protocol("WM_DELETE_WINDOW", self.cancel_calibration)
 
         self.calib_label = tk.Label(
             self.calib_window, text="Clear sensor please", font=("Arial", 15)
         )
         self.calib_label.pack(pady=20)
         self.calib_label.place(relx=0.5, rely=0.5, anchor=tk.CENTER)
-        self.calib_window.update()
 
-        time.sleep(3)
-        self.bright_level = self.measure_light()
+    def show_calibration_prompt(self, view):
+        if self.calib_window is not None and view.prompt and self.calib_label.cget("text") != view.prompt:
+            self.calib_label.config(text=view.prompt)
 
-        self.calib_label.config(text="Cover sensor please")
-        self.calib_window.update()
+    def cancel_calibration(self):
+        self.engine.release(self.calibrating_track)
+        self.calib_window.destroy()
+        self.calib_window = None
 
-        time.sleep(3)
-        self.dim_level = self.measure_light()
-        self.shadow_threshold = (self.dim_level + self.bright_level) / 2
-        print(f"Bright level: {self.bright_level:.0f}, dim level: {self.dim_level:.0f}, shadow threshold: {self.shadow_threshold:.0f}")
+    def finish_calibration(self, view):
+        if view.track != self.calibrating_track:
+            return
+        self.calibrating_track = None
+        if self.calib_window is None:
+            return  # Cancelled
 
-        self.calib_label.config(text="Calibration complete!")
+        self.calib_label.config(text=view.prompt)
         self.calib_window.after(2000, self.calib_window.destroy)
-        self.calibration_label.config(text="Done calibrating")
+        self.calib_window = None
+        self.calibration_label.config(
+            text=f"Done calibrating Track {view.track} (noise margin: {view.calibration.noise_margin:.0f})"
+        )
         self.root.after(2000, lambda: self.calibration_label.config(text=""))
 
-    def measure_light(self):
-        values = []
-        self.calib_label.config(text="Measuring...")
-        self.calib_window.update()
-
-        start_time = time.time()
-        self.arduino.reset_input_buffer()  # Clear any previous data in buffer
-        while time.time() - start_time < 2:
-            if self.arduino.in_waiting > 0:
-                line = self.arduino.readline().decode("utf-8").strip()
-                try:
-                    voltage = float(line)
-                    values.append(voltage)
-                except ValueError:
-                    continue
-
-        avg_value = sum(values) / len(values) if values else 0
-        return avg_value
-
-    def start_measurement(
-        self,
-    ):
-        self.name_label.pack_forget()
-        self.name_entry.pack_forget()
-        self.email_label.pack_forget()
-        self.email_entry.pack_forget()
-        self.consent_check.pack_forget()
-        self.privacy_statement.pack_forget()
-        # self.track_label.pack_forget()
-        # self.track_entry.pack_forget()
-        self.calibrate_button.pack_forget()
-        self.calibration_label.pack_forget()
-        self.start_button.pack_forget()
-        self.quit_button.pack_forget()
-
-        # Create a separate window for measurement
-        self.measurement_window = tk.Toplevel(self.root)
-        self.measurement_window.title("Measurement")
-        center_window(self.measurement_window, 400, 200)        
-
-        self.label = tk.Label(self.measurement_window, text="", font=("Arial", 20))
-        self.label.pack(pady=20)
-
-        self.running = True
-        self.sensor_thread = threading.Thread(target=self.read_sensor, daemon=True)
-        self.sensor_thread.start()
-
-    def read_sensor(self):
-        self.arduino.reset_input_buffer()  # Clear any previous data in buffer
-
-        # Timing variables
-        timer_running = False
-        last_ui_update_time = time.time()
-        start_time = 0
-        last_lap_time = 0
-        self.countdown_left = self.countdown_duration
-        
-        # Temporary parameters
-        voltage = None
-        lap_count = 0
-        previous_light = "bright"
-
-        while self.running:
-            if self.arduino.in_waiting > 0:
-                line = self.arduino.readline().decode("utf-8").strip()
-                try:
-                    voltage = float(line)
-                except ValueError:
-                    continue
-
-            if voltage is not None:
-                current_time = time.time()
-                print(f"Measured value: {voltage:.2f}")
-
-                # Detect light-to-dark transition (shadow detected), with at least 0.5 seconds between laps
-                if voltage <= self.shadow_threshold and previous_light == "bright" and current_time - last_lap_time >= self.debounce_time:
-                    if not timer_running:
-                        timer_running = True
-                        start_time = current_time
-                    lap_count += 1
-                    print(f"Lap count switch to: {lap_count}, time: {(current_time - start_time):.2f}")
-                    if lap_count >= self.number_laps + 1:
-                        elapsed_time = current_time - start_time
-                        self.running = False
-                        timer_running = False
-                        self.show_result_screen(elapsed_time)
-                    previous_light = "dim"
-                    last_lap_time = current_time
-
-                # Detect dark-to-light transition (reset state)
-                if voltage >= self.shadow_threshold:
-                    previous_light = "bright"
-
-                # UI update only every self.ui_update_period seconds
-                if current_time - last_ui_update_time > self.ui_update_period:
-                    self.root.after(0, self.update_ui, lap_count, start_time)
-                    last_ui_update_time = current_time
-                
-                # Reset voltage so we only trigger this loop when values come in
-                voltage = None
-                time.sleep(0.005)
-
-    def update_ui(self, lap_count, start_time):
-        if start_time == 0 and self.countdown_left >= 0:
-            self.measurement_window.after(
-                0, 
-                self.label.config,
-                {
-                    "text": f"Ready? Race starting in\n\n {self.countdown_left:.1f}"
-                },
-            )
-            self.countdown_left -= self.ui_update_period
-        elif start_time == 0:
-            self.measurement_window.after(
-                0, 
-                self.label.config,
-                {
-                    "text": "GO!"
-                },
-            )
-        else:
-            elapsed_time = time.time() - start_time
-            self.measurement_window.after(
-                0, 
-                self.label.config,
-                {
-                    "text": f"Race underway!\n\nElapsed time: {elapsed_time:.1f} s\nCurrent lap: {lap_count} / {self.number_laps}"
-                },
-            )
+    def show_race_window(self):
+        """Combined view of all tracks, shared by the races running on them."""
+        if self.race_window is not None and self.race_window.winfo_exists():
+            return
 
-    def show_result_screen(self, elapsed_time):
-        # Create a new window for the result
-        self.result_window = tk.Toplevel(self.root)
-        self.result_window.title("Measurement Result")
-        center_window(self.result_window, 400, 200)
+        self.race_window = tk.Toplevel(self.root)
+        self.race_window.title("Measurement")
+        center_window(self.race_window, 400, 200 * len(self.snapshot.lanes))
+
+        self.race_labels = {}
+        for view in self.snapshot.lanes:
+            label = tk.Label(self.race_window, text="", font=("Arial", 20))
+            label.pack(pady=20)
+            self.race_labels[view.track] = label
+        self.render_loop.start()
+
+    def close_race_window(self):
+        self.render_loop.stop()
+        print(f"Race view rendering: {self.render_loop.stats()}")
+        self.race_window.destroy()
+        self.race_window = None
+
+    def render_race_view(self):
+        """Text of every lane's label, from the latest snapshot."""
+        now = time.monotonic()
+        return {
+            label: self.race_text(self.lane_view(track), now)
+            for track, label in self.race_labels.items()
+        }
+
+    def race_text(self, view, now):
+        lane = f"Track {view.track}"
+        state = view.state
+        if state.phase == "countdown":
+            countdown_left = self.countdown_duration - (now - state.started)
+            if countdown_left > 0:
+                return f"{lane}: ready? Race starting in\n\n {countdown_left:.1f}"
+            return f"{lane}: GO!"
+        if state.phase == "racing":
+            return f"{lane}: race underway!\n\nElapsed time: {now - state.started:.1f} s\nCurrent lap: {state.lap_count} / {self.engine.number_laps}"
+        if state.phase == "finished":
+            return f"{lane}: finished in {state.elapsed_time:.2f} s"
+        return f"{lane}: waiting for racer"
+
+    def start_measurement(self, track, name, email):
+        view = self.lane_view(track)
+        if view.owner == "calibration":
+            messagebox.showerror("Calibration", "Please wait for the calibration to finish.")
+            return
+        if view.owner == "race" or track in self.result_windows:
+            messagebox.showerror("Track busy", f"Track {track} is still in use, please pick another track.")
+            return
+        # The engine's race task takes over the lane from here
+        self.engine.start_race(track, name, email)
+
+        # Clear the form for the next racer, who can use another track meanwhile
+        self.name_var.set("")
+        self.email_var.set("")
+        self.consent_var.set(False)
 
-        name = self.name_var.get()
-        email = self.email_var.get()
+        self.show_race_window()
+
+    def show_result_screen(self, view):
+        track, elapsed_time = view.track, view.state.elapsed_time
+        # Create a new window for the result
+        result_window = tk.Toplevel(self.root)
+        result_window.title(f"Measurement Result Track {track}")
+        center_window(result_window, 400, 200)
+        self.result_windows[track] = result_window
+        # Window closed, the same as discarding, so the track doesn't stay in use
+        result_window.protocol("WM_DELETE_WINDOW", lambda: self.return_to_main(track))
+
+        name, email = view.racer
         result_label = tk.Label(
-            self.result_window,
+            result_window,
             text=f"{name}, your time: {elapsed_time:.2f} sec",
             font=("Arial", 15),
         )
         result_label.pack(pady=20)
 
+        laps = view.result
+        laps_label = tk.Label(
+            result_window,
+            text=f"Best lap: {laps.best_lap:.2f} sec, consistency: ± {laps.consistency:.2f} sec",
+            font=("Arial", 12),
+        )
+        laps_label.pack()
+
+        rank_text = f"That's #{view.rank} today!"
+        if view.best is not None and view.rank > 1:
+            rank_text += f" Fastest so far: {view.best:.2f} sec"
+        rank_label = tk.Label(result_window, text=rank_text, font=("Arial", 12))
+        rank_label.pack()
+
         # Add a button to discard the measurement and return to the main screen
         discard_button = tk.Button(
-            self.result_window,
+            result_window,
             text="Discard measurement",
-            command=self.return_to_main,
+            command=lambda: self.return_to_main(track),
             font=("Arial", 15),
         )
         discard_button.pack(pady=10)
 
         # Add a button to upload the time to the leaderboard and exit
         upload_button = tk.Button(
-            self.result_window,
+            result_window,
             text="Upload time to leaderboard and exit",
-            command=lambda: self.return_to_main(
-                name=name, email=email, track=1, elapsed_time=elapsed_time
-            ),
+            command=lambda: self.return_to_main(track, save=True),
             font=("Arial", 15),
         )
         upload_button.pack(pady=10)
 
-    def return_to_main(self, name=None, email=None, track=None, elapsed_time=None):
-        if name and email and track and elapsed_time:
-            # Push results to Google Sheets
-            self.push_to_gsheet(name, email, track, elapsed_time)
-        
-        # Close the result window
-        self.result_window.destroy()
-        self.measurement_window.destroy()
-
-        # Reset timer variables
-        self.start_time = None
-        self.second_crossing = None
-        self.timer_running = False
-
-        # Re-display the main screen widgets
-        self.create_main_screen()
+    def return_to_main(self, track, save=False):
+        if save:
+            # Stored locally and queued for upload by the engine, so a slow
+            # or missing network connection doesn't hold up the UI
+            self.engine.save_result(track)
+        else:
+            self.engine.release(track)
 
-    def push_to_gsheet(self, name, email, track, elapsed_time):
-        url = "https://script.google.com/macros/s/AKfycbyUeNjw-wHF3ODJ8TyBLEv41bUDjciQFqEs-wXTWizN1E8xFT3KzA9a11YNHTarRBxUPw/exec"
-
-        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-        minutes = int(elapsed_time // 60)
-        seconds = int(elapsed_time % 60)
-        hundredths = int((elapsed_time * 100) % 100)
-        formatted_time = f"{minutes:02}:{seconds:02}:{hundredths:02}"
-
-        payload = {
-            "sheet": "Track",
-            "action": "add",
-            "values": {
-                "Timestamp": timestamp,
-                "Name": name,
-                "E-mail": email,
-                "Track": track,
-                "Time": formatted_time,
-            },
-        }
-        headers = {
-            "Content-Type": "application/json",
-        }
+        # Close the result window; the race view follows once the engine
+        # reports that no track is in use
+        self.result_windows.pop(track).destroy()
 
-        response = requests.request("POST", url, json=payload, headers=headers)
+    def toggle_debug_overlay(self):
+        if self.debug_window is not None:
+            self.debug_window.destroy()
+            self.debug_window = None
+            return
+
+        self.debug_window = tk.Toplevel(self.root)
+        self.debug_window.title("Latency metrics")
+        self.debug_label = tk.Label(self.debug_window, font=("Courier", 10), justify=tk.LEFT)
+        self.debug_label.pack(padx=10, pady=10)
+        self.update_debug_overlay()
+
+    def update_debug_overlay(self):
+        if self.debug_window is None or not self.debug_window.winfo_exists():
+            self.debug_window = None
+            return
+
+        lines = [f"{'':22}{'count':>8}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}"]
+        for name, summary in sorted(METRICS.summary().items()):
+            lines.append(
+                f"{name:22}{summary['count']:>8}{summary['p50_ms']:>9.2f}"
+                f"{summary['p99_ms']:>9.2f}{summary['max_ms']:>9.2f}"
+            )
+        lines.append(f"render: {self.render_loop.stats()['dropped_frames']} dropped frames")
+        for lane in self.engine.session.lanes:
+            lines.append(f"{lane}: {lane.samples.stats()}")
+        self.debug_label.config(text="\n".join(lines))
+        self.debug_window.after(500, self.update_debug_overlay)
 
 if __name__ == "__main__":
-    RacetrackUI()
+    RacetrackUI(RaceEngine(connect, trace_directory=data_path("traces"))).run()
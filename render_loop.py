@@ -0,0 +1,79 @@
+"""Fixed-rate UI refresh, driven from the Tk thread."""
+
+import time
+
+from metrics import METRICS
+
+
+class RenderLoop:
+    """Redraws at a fixed frame rate from whatever state is current.
+
+    Each frame, render() returns {widget: text} for everything on screen;
+    only widgets whose text changed since the last frame are reconfigured.
+    Other threads never touch Tk, they just publish state for render() to
+    read.
+    """
+
+    def __init__(self, root, render, fps=20):
+        self.root = root
+        self.render = render
+        self.period = 1 / fps
+        self._shown = {}
+        self._job = None
+        self._next_frame = None
+        self._callback_delay = METRICS.histogram("tk_callback_delay")
+
+        self.frames = 0
+        self.dropped_frames = 0
+        self.widget_updates = 0
+        self.total_frame_time = 0.0
+        self.max_frame_time = 0.0
+
+    @property
+    def running(self):
+        return self._job is not None
+
+    def start(self):
+        if self._job is None:
+            self._next_frame = time.monotonic()
+            self._job = self.root.after(0, self._frame)
+
+    def stop(self):
+        if self._job is not None:
+            self.root.after_cancel(self._job)
+            self._job = None
+        self._shown.clear()
+
+    def _frame(self):
+        started = time.monotonic()
+        # A late frame (e.g. the Tk thread was busy) counts the frames it replaced as dropped
+        late_by = started - self._next_frame
+        self._callback_delay.record(max(late_by, 0.0))
+        if late_by > self.period:
+            skipped = int(late_by / self.period)
+            self.dropped_frames += skipped
+            self._next_frame += skipped * self.period
+
+        for widget, text in self.render().items():
+            if self._shown.get(widget) != text and widget.winfo_exists():
+                widget.config(text=text)
+                self._shown[widget] = text
+                self.widget_updates += 1
+
+        frame_time = time.monotonic() - started
+        self.frames += 1
+        self.total_frame_time += frame_time
+        self.max_frame_time = max(self.max_frame_time, frame_time)
+
+        self._next_frame += self.period
+        delay = max(0, int((self._next_frame - time.monotonic()) * 1000))
+        self._job = self.root.after(delay, self._frame)
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "dropped_frames": self.dropped_frames,
+            "widget_updates": self.widget_updates,
+            "avg_frame_ms": 1000 * self.total_frame_time / self.frames if self.frames else 0.0,
+            "max_frame_ms": 1000 * self.max_frame_time,
+        }
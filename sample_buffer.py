@@ -0,0 +1,137 @@
+"""Fixed-size buffer between the serial reader thread and the lap detection."""
+
+from array import array
+import threading
+import time
+
+from metrics import METRICS
+from sensor_protocol import new_sample_arrays
+
+
+class SampleRingBuffer:
+    """Single-producer, single-consumer circular buffer of (timestamp, value) samples.
+
+    Memory is allocated once up front. The producer only ever advances
+    `_head` and the consumer only `_tail`, and each index is published after
+    the data it covers is written/read, so no lock is needed between the two
+    threads. When the consumer falls behind and the buffer is full, new
+    samples are dropped and counted in `overruns`. A consumer with nothing
+    else to do can block in wait() rather than polling, or set on_write to
+    be told about new samples, e.g. on an event loop.
+    """
+
+    def __init__(self, capacity=1 << 16):
+        self.capacity = capacity
+        self._times = array("d", bytes(8 * capacity))
+        self._values = array("d", bytes(8 * capacity))
+        self._head = 0  # Total samples written
+        self._tail = 0  # Total samples consumed
+        self._written = threading.Event()
+        self.on_write = None  # Called on the producer thread after each write
+
+        self.overruns = 0
+        self.high_water = 0
+        self.last_write_time = 0.0  # time.monotonic() of the latest write
+
+    def __len__(self):
+        return self._head - self._tail
+
+    def write(self, times, values):
+        """Producer side: stores as many samples as fit, returns how many were stored."""
+        head = self._head
+        count = min(len(values), self.capacity - (head - self._tail))
+        self.overruns += len(values) - count
+        if count <= 0:
+            return 0
+
+        start = head % self.capacity
+        first = min(count, self.capacity - start)
+        self._times[start : start + first] = times[:first]
+        self._values[start : start + first] = values[:first]
+        if first < count:
+            self._times[: count - first] = times[first:count]
+            self._values[: count - first] = values[first:count]
+
+        self.last_write_time = time.monotonic()
+        self._head = head + count
+        self.high_water = max(self.high_water, self._head - self._tail)
+        self._written.set()
+        if self.on_write is not None:
+            self.on_write()
+        return count
+
+    def read(self, times, values):
+        """Consumer side: appends all pending samples to times/values, returns the count."""
+        tail, head = self._tail, self._head
+        count = head - tail
+        if count == 0:
+            return 0
+
+        start = tail % self.capacity
+        first = min(count, self.capacity - start)
+        times.extend(self._times[start : start + first])
+        values.extend(self._values[start : start + first])
+        if first < count:
+            times.extend(self._times[: count - first])
+            values.extend(self._values[: count - first])
+
+        self._tail = head
+        return count
+
+    def wait(self, timeout=None):
+        """Consumer side: blocks until samples are pending or timeout, returns whether any are."""
+        # Clear before checking, so a write in between still wakes us up
+        self._written.clear()
+        if self._head == self._tail:
+            self._written.wait(timeout)
+        return self._head != self._tail
+
+    def discard(self):
+        """Consumer side: drops everything pending, e.g. before a new measurement."""
+        self._tail = self._head
+
+    def stats(self):
+        return {
+            "pending": len(self),
+            "high_water": self.high_water,
+            "overruns": self.overruns,
+            "capacity": self.capacity,
+        }
+
+
+class AcquisitionThread(threading.Thread):
+    """Producer: drains the serial port into a SampleRingBuffer and does nothing else.
+
+    Sleeps in the serial driver while no data comes in, so it only wakes up
+    when the firmware sends something (or the port's read timeout passes).
+    """
+
+    def __init__(self, reader, buffer):
+        super().__init__(name="sensor-acquisition", daemon=True)
+        self.reader = reader
+        self.buffer = buffer
+        self.wakeups = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        # Reads block until data arrives, so serial_read only counts from
+        # then on (reading and decoding); the wait is the inter-arrival time
+        read_latency = METRICS.histogram("serial_read")
+        inter_arrival = METRICS.histogram("sample_inter_arrival")
+        times, values = new_sample_arrays()
+        last_arrival = None
+
+        while not self._stop_event.is_set():
+            self.wakeups += 1
+            if self.reader.read_batch(times, values, wait=True):
+                arrived = self.reader.ready_time
+                read_latency.record(time.monotonic() - arrived)
+                if last_arrival is not None:
+                    inter_arrival.record(arrived - last_arrival)
+                last_arrival = arrived
+
+                self.buffer.write(times, values)
+                del times[:], values[:]
+
+    def stop(self):
+        self._stop_event.set()
@@ -0,0 +1,229 @@
+"""Serial protocol between the host and the racetrack Arduino.
+
+The firmware starts out in the legacy ASCII mode: one light reading per line,
+e.g. b"512.00\\r\\n". When the host sends MODE_BINARY_COMMAND, newer firmware
+answers with BINARY_ACK and switches to fixed-size binary frames:
+
+    uint16 magic        0xA55A
+    uint16 sequence     increments by one per frame, wraps at 65536
+    uint32 t0_us        device micros() of the first sample in the frame
+    uint16 period_us    time between two consecutive samples
+    uint16 samples[32]  raw analogRead() values
+
+All fields are little-endian. Older firmware ignores the command and keeps
+sending lines, in which case the reader falls back to the ASCII protocol.
+
+In binary mode the host also sets how the firmware samples with
+b"RATE <period_us> <decimation>\n": the time between two analogRead()s,
+and how many of those readings are folded into each (min, max) pair that
+is sent. Folding keeps a car's shadow in the stream (the dip survives in
+the minimum) at a fraction of the data rate. Frames carry the resulting
+period_us, which is how the host sees the new mode take effect. Firmware
+without the command keeps its rate.
+"""
+
+from array import array
+from collections import namedtuple
+import struct
+import sys
+import time
+
+FRAME_MAGIC = 0xA55A
+FRAME_HEADER = struct.Struct("<HHIH")
+SAMPLES_PER_FRAME = 32
+FRAME_SIZE = FRAME_HEADER.size + 2 * SAMPLES_PER_FRAME
+
+MODE_BINARY_COMMAND = b"MODE BIN\n"
+BINARY_ACK = b"BIN OK"
+RATE_COMMAND = b"RATE %d %d\n"
+
+# How the firmware samples, see RATE_COMMAND. Full rate around races, and
+# between them just enough to follow the ambient light and spot a hand
+SensorMode = namedtuple("SensorMode", "period_us decimation")
+RACE_MODE = SensorMode(250, 1)  # 4 kHz, every reading
+IDLE_MODE = SensorMode(1000, 32)  # 1 kHz folded to 62.5 values/s, two frames a second
+
+_MAGIC_BYTES = struct.pack("<H", FRAME_MAGIC)
+_SAMPLES = struct.Struct(f"<{SAMPLES_PER_FRAME}H")
+_SAMPLE_HIGH_BYTES = bytes(range(4))  # analogRead() is 10 bits, at most 1023
+_BUFFER_FRAMES = 256
+
+
+def encode_frame(sequence, t0_us, period_us, samples):
+    """Packs one binary frame, used by the loopback stand-in and the simulator."""
+    return FRAME_HEADER.pack(
+        FRAME_MAGIC, sequence & 0xFFFF, t0_us & 0xFFFFFFFF, period_us
+    ) + _SAMPLES.pack(*samples)
+
+
+class SampleReader:
+    """Reads light samples from the Arduino in either binary or ASCII mode.
+
+    Samples are appended to caller-owned arrays by read_batch(), so the hot
+    loop doesn't allocate per sample. In binary mode timestamps come from the
+    device clock, in ASCII mode from the host clock at read time.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.binary = False
+        self.mode = None  # None until set_mode(), i.e. whatever the firmware defaults to
+
+        self._buffer = bytearray(FRAME_SIZE * _BUFFER_FRAMES)
+        self._view = memoryview(self._buffer)
+        self._end = 0
+
+        self._last_sequence = None
+        self._last_t0_us = None
+        self._time_offset_us = 0
+        self._period_us = None
+        self._offsets = ()
+
+        self.frames = 0
+        self.dropped_frames = 0
+        self.resyncs = 0
+        self.ready_time = None  # When read_batch() last had its data, see there
+
+    def negotiate(self, timeout=2.0):
+        """Asks the firmware for binary frames, falls back to ASCII if it doesn't answer."""
+        self.port.reset_input_buffer()
+        self.port.write(MODE_BINARY_COMMAND)
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            line = self.port.readline()
+            if line.strip() == BINARY_ACK:
+                self.binary = True
+                break
+
+        self._end = 0
+        print(f"Sensor protocol: {'binary' if self.binary else 'ASCII'}")
+        return self.binary
+
+    def set_mode(self, mode):
+        """Asks the firmware to sample in this SensorMode, returns False in ASCII mode."""
+        if not self.binary:
+            return False
+        self.port.write(RATE_COMMAND % mode)
+        self.mode = mode
+        return True
+
+    def read_batch(self, times, values, wait=False):
+        """Appends all samples currently available to times/values, returns the count.
+
+        With wait=True, blocks in the serial driver (up to the port's timeout)
+        until there's enough data for at least one frame or line, instead of
+        returning 0 and leaving the caller to poll.
+        """
+        # Read straight into the free part of the reusable buffer
+        free = len(self._buffer) - self._end
+        waiting = min(self.port.in_waiting, free)
+        if waiting == 0 and wait and free > 0:
+            needed = FRAME_SIZE - self._end if self.binary else 1
+            self._end += self.port.readinto(self._view[self._end : self._end + min(max(needed, 1), free)])
+            waiting = min(self.port.in_waiting, len(self._buffer) - self._end)
+        # After any wait for data, so the caller can time just the reading and decoding
+        self.ready_time = time.monotonic()
+        if waiting > 0:
+            self._end += self.port.readinto(self._view[self._end : self._end + waiting])
+
+        if self.binary:
+            return self._decode_frames(times, values)
+        return self._decode_lines(times, values)
+
+    def _decode_frames(self, times, values):
+        buffer, view = self._buffer, self._view
+        position, end = 0, self._end
+        count = 0
+
+        while end - position >= FRAME_SIZE:
+            after = position + FRAME_SIZE
+            if (
+                buffer[position] != 0x5A
+                or buffer[position + 1] != 0xA5
+                # The samples are 10-bit readings, high bytes 0 to 3 (whatever's
+                # left after deleting those is data that isn't a frame)
+                or buffer[position + FRAME_HEADER.size + 1 : after : 2].translate(None, _SAMPLE_HIGH_BYTES)
+                # and the next frame's magic follows, once it has arrived
+                or (end - after >= len(_MAGIC_BYTES) and not buffer.startswith(_MAGIC_BYTES, after))
+            ):
+                # Lost sync (e.g. a dropped byte), skip ahead to the next magic
+                self.resyncs += 1
+                found = buffer.find(_MAGIC_BYTES, position + 1, end)
+                position = found if found >= 0 else end - 1
+                continue
+            if end - after < len(_MAGIC_BYTES) and not self._follows(position):
+                break  # Can't be verified yet, wait for the next frame's magic
+
+            _, sequence, t0_us, period_us = FRAME_HEADER.unpack_from(buffer, position)
+            if self._last_sequence is not None:
+                self.dropped_frames += (sequence - self._last_sequence - 1) & 0xFFFF
+            self._last_sequence = sequence
+            self.frames += 1
+
+            # micros() wraps every ~71 minutes, keep the device clock monotonic
+            if self._last_t0_us is not None and t0_us < self._last_t0_us:
+                self._time_offset_us += 1 << 32
+            self._last_t0_us = t0_us
+            if period_us != self._period_us:
+                self._period_us = period_us
+                self._offsets = [i * period_us / 1e6 for i in range(SAMPLES_PER_FRAME)]
+
+            t0 = (t0_us + self._time_offset_us) / 1e6
+            times.extend(map(t0.__add__, self._offsets))
+            samples = view[position + FRAME_HEADER.size : after].cast("H")
+            if sys.byteorder == "little":
+                values.extend(samples)
+            else:
+                values.extend(_SAMPLES.unpack_from(buffer, position + FRAME_HEADER.size))
+            samples.release()
+
+            count += SAMPLES_PER_FRAME
+            position = after
+
+        self._compact(position)
+        return count
+
+    def _follows(self, position):
+        # The newest frame has no magic after it yet. It's taken right away if
+        # it continues the sequence, so a live stream isn't held back a frame
+        sequence = FRAME_HEADER.unpack_from(self._buffer, position)[1]
+        return self._last_sequence is not None and sequence == (self._last_sequence + 1) & 0xFFFF
+
+    def _decode_lines(self, times, values):
+        buffer = self._buffer
+        position, end = 0, self._end
+        now = time.monotonic()
+        count = 0
+
+        while True:
+            newline = buffer.find(b"\n", position, end)
+            if newline < 0:
+                break
+            try:
+                # float() accepts bytes, so no decode() per line
+                value = float(buffer[position:newline])
+            except ValueError:
+                pass
+            else:
+                times.append(now)
+                values.append(value)
+                count += 1
+            position = newline + 1
+
+        if position == 0 and end == len(buffer):
+            # A full buffer without a newline is garbage, throw it away
+            position = end
+        self._compact(position)
+        return count
+
+    def _compact(self, position):
+        remaining = self._end - position
+        if remaining and position:
+            self._buffer[:remaining] = self._buffer[position : self._end]
+        self._end = remaining
+
+
+def new_sample_arrays():
+    """Returns empty (times, values) arrays in the layout read_batch() expects."""
+    return array("d"), array("d")
@@ -0,0 +1,337 @@
+"""Simulated racetrack Arduino, for running the app and the benchmarks without hardware.
+
+Generates the photodiode signal of a track: a bright level that drifts with
+the ambient light, sensor noise, and a dip with soft edges whenever the car
+passes. It speaks the same serial protocol as the firmware, ASCII lines
+until the host asks for binary frames, and follows the host's RATE
+commands, min/max folding included.
+
+In-process, SimulatedArduino.port is a serial.Serial stand-in the app's
+Lane can use directly. On Linux/macOS it can also serve a virtual serial
+port (pty) that the real app connects to:
+
+    python simulator.py --tracks 2 --laps 7 --lap-time 2.5
+    RACETRACK_PORTS=/dev/pts/4,/dev/pts/5 python racetrack-counter-ui.py
+"""
+
+import argparse
+import math
+import os
+import random
+import sys
+import threading
+import time
+
+from sensor_protocol import BINARY_ACK, MODE_BINARY_COMMAND, SAMPLES_PER_FRAME, encode_frame
+
+
+class SimulatedPort:
+    """Host side of the in-process link, a stand-in for serial.Serial.
+
+    Reads wait up to `timeout` seconds for data like pyserial's do, writes
+    go to the simulated firmware as commands.
+    """
+
+    def __init__(self, arduino, timeout=1.0):
+        self.arduino = arduino
+        self.timeout = timeout
+        self._data = bytearray()
+        self._arrived = threading.Condition()
+
+    @property
+    def in_waiting(self):
+        return len(self._data)
+
+    def write(self, data):
+        self.arduino.receive(bytes(data))
+        return len(data)
+
+    def read(self, size=1):
+        with self._arrived:
+            self._arrived.wait_for(lambda: len(self._data) >= size, self.timeout)
+            data = bytes(self._data[:size])
+            del self._data[:size]
+        return data
+
+    def readinto(self, buffer):
+        with self._arrived:
+            self._arrived.wait_for(lambda: len(self._data) >= len(buffer), self.timeout)
+            size = min(len(buffer), len(self._data))
+            buffer[:size] = self._data[:size]
+            del self._data[:size]
+        return size
+
+    def readline(self):
+        with self._arrived:
+            self._arrived.wait_for(lambda: b"\n" in self._data, self.timeout)
+            end = self._data.find(b"\n") + 1 or len(self._data)
+            data = bytes(self._data[:end])
+            del self._data[:end]
+        return data
+
+    def reset_input_buffer(self):
+        with self._arrived:
+            self._data.clear()
+
+    def close(self):
+        self.arduino.stop()
+
+    def _feed(self, data):
+        with self._arrived:
+            self._data += data
+            self._arrived.notify_all()
+
+
+class SimulatedArduino(threading.Thread):
+    """Firmware stand-in: samples the simulated light level and sends it to the host.
+
+    Device time runs `speed` times as fast as the wall clock, so load tests
+    can push several times the real sample rate through the host; with
+    speed=None samples are produced as fast as the host reads them (at most
+    `max_backlog` bytes ahead). now() tells where device time is. Races are
+    scheduled with start_race(), which returns the ground truth.
+    """
+
+    def __init__(
+        self,
+        rate=4000,
+        bright_level=600.0,
+        dim_level=100.0,
+        noise=8.0,
+        drift=30.0,
+        drift_period=120.0,
+        lap_time=2.0,
+        lap_jitter=0.05,
+        shadow_time=0.02,
+        edge_time=0.001,
+        binary_firmware=True,
+        speed=1.0,
+        max_backlog=64 * 1024,
+        seed=None,
+    ):
+        super().__init__(name="simulated-arduino", daemon=True)
+        self.period_us = round(1e6 / rate)
+        self.decimation = 1
+        self.bright_level = bright_level
+        self.dim_level = dim_level
+        self.noise = noise
+        self.drift = drift  # Amplitude of the ambient light swing
+        self.drift_period = drift_period
+        self.lap_time = lap_time
+        self.lap_jitter = lap_jitter  # Standard deviation of a lap, relative to lap_time
+        self.shadow_time = shadow_time  # How long the car covers the sensor at lap_time pace
+        self.edge_time = edge_time
+        self.binary_firmware = binary_firmware
+        self.speed = speed
+        self.max_backlog = max_backlog
+
+        self.port = SimulatedPort(self)
+        self.covered = False  # A hand over the sensor, e.g. during calibration
+        self.binary = False
+        self.commands = []  # Everything the host sent, for inspection
+        self.samples_sent = 0
+        self.dropped_bytes = 0
+
+        self._random = random.Random(seed)
+        self._sequence = 0
+        self._time = 0.0  # Device time of the next reading
+        self._shadows = []  # (falling edge, rising edge) midpoints in device time, in order
+        self._shadow_index = 0
+        self._commands = []
+        self._pending_command = b""
+        self._pty = None
+        self._stop_event = threading.Event()
+
+    def now(self):
+        """Device time in seconds: the timestamp of the next reading."""
+        return self._time
+
+    def start_race(self, number_laps=7, delay=1.0):
+        """Schedules number_laps laps starting `delay` seconds of device time from now.
+
+        Returns the ground truth: the number_laps + 1 crossing times, at the
+        middle of the falling edge of each shadow.
+        """
+        start = self.now() + delay
+        if self._shadows:
+            start = max(start, self._shadows[-1][1] + self.edge_time)
+        crossings = [start]
+        for _ in range(number_laps):
+            lap = self.lap_time * max(0.5, self._random.gauss(1.0, self.lap_jitter))
+            crossings.append(crossings[-1] + lap)
+
+        # The car is slower on a slow lap, so it shades the sensor for longer
+        laps = [self.lap_time] + [b - a for a, b in zip(crossings, crossings[1:])]
+        for crossing, lap in zip(crossings, laps):
+            self._shadows.append((crossing, crossing + self.shadow_time * lap / self.lap_time))
+        return crossings
+
+    def open_pty(self):
+        """Serves a virtual serial port instead of self.port, returns its device path."""
+        import tty  # POSIX only
+
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        os.set_blocking(master, False)
+        self._pty = master
+        self._pty_slave = slave  # Kept open so the port survives the host reconnecting
+        self.speed = self.speed or 1.0  # No backpressure through a pty
+        return os.ttyname(slave)
+
+    def receive(self, data):
+        """Bytes written by the host, handled by the firmware loop."""
+        self._commands.append(data)
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        started = time.perf_counter()
+        while not self._stop_event.is_set():
+            self._handle_commands()
+            if self.speed is None:
+                if self.port.in_waiting < self.max_backlog:
+                    for _ in range(8):
+                        self._send_frame()
+                else:
+                    time.sleep(0.0005)
+                continue
+
+            # Send everything that's due, in bursts like the USB link does
+            while self._time + self._frame_time() <= (time.perf_counter() - started) * self.speed:
+                self._send_frame()
+            time.sleep(0.002)
+
+    def _handle_commands(self):
+        if self._pty is not None:
+            try:
+                self._commands.append(os.read(self._pty, 256))
+            except (BlockingIOError, OSError):
+                pass
+        while self._commands:
+            self._pending_command += self._commands.pop(0)
+            while b"\n" in self._pending_command:
+                line, self._pending_command = self._pending_command.split(b"\n", 1)
+                self.commands.append(line.strip())
+                # Old firmware ignores commands, newer switches to binary frames
+                if not self.binary_firmware:
+                    continue
+                if line.strip() == MODE_BINARY_COMMAND.strip():
+                    self._send(BINARY_ACK + b"\r\n")
+                    self.binary = True
+                elif line.startswith(b"RATE ") and self.binary:
+                    period_us, decimation = map(int, line.split()[1:3])
+                    self.period_us, self.decimation = period_us, max(decimation, 1)
+
+    def _frame_time(self):
+        """Device time one frame covers in the current mode."""
+        return SAMPLES_PER_FRAME * self._sent_period_us() / 1e6
+
+    def _sent_period_us(self):
+        # Each folded group of readings becomes a (min, max) pair
+        return self.period_us if self.decimation == 1 else self.period_us * self.decimation // 2
+
+    def _send_frame(self):
+        t0 = self._time
+        if not self.binary or self.decimation == 1:
+            samples = self._samples(t0, SAMPLES_PER_FRAME)
+        else:
+            readings = self._samples(t0, SAMPLES_PER_FRAME // 2 * self.decimation)
+            samples = []
+            for start in range(0, len(readings), self.decimation):
+                group = readings[start : start + self.decimation]
+                low, high = min(group), max(group)
+                # In the order they happened, so the dip's timing is kept as well as possible
+                samples += (low, high) if group.index(low) <= group.index(high) else (high, low)
+
+        if self.binary:
+            self._send(encode_frame(self._sequence, round(t0 * 1e6), self._sent_period_us(), samples))
+            self._time += self._frame_time()
+        else:
+            self._send(b"".join(b"%d.00\r\n" % sample for sample in samples))
+            self._time += SAMPLES_PER_FRAME * self.period_us / 1e6
+        self._sequence += 1
+        self.samples_sent += SAMPLES_PER_FRAME
+
+    def _send(self, data):
+        if self._pty is None:
+            self.port._feed(data)
+            return
+        try:
+            os.write(self._pty, data)
+        except (BlockingIOError, OSError):
+            self.dropped_bytes += len(data)  # Nobody reading, like a USB link without a host
+
+    def _samples(self, t0, count):
+        """Raw analogRead() values of `count` readings starting at device time t0."""
+        period = self.period_us / 1e6
+        ambient = self.bright_level + self.drift * math.sin(2 * math.pi * t0 / self.drift_period)
+        gauss, noise = self._random.gauss, self.noise
+
+        # Shadows that are over can't affect this frame or any later one
+        shadows, edge = self._shadows, self.edge_time
+        while self._shadow_index < len(shadows) and shadows[self._shadow_index][1] + edge < t0:
+            self._shadow_index += 1
+
+        end = t0 + count * period
+        if self.covered:
+            levels = [self.dim_level] * count
+        elif self._shadow_index < len(shadows) and shadows[self._shadow_index][0] - edge < end:
+            levels = [self._light(t0 + i * period, ambient) for i in range(count)]
+        else:
+            levels = [ambient] * count
+        return [min(max(int(level + gauss(0, noise)), 0), 1023) for level in levels]
+
+    def _light(self, t, ambient):
+        fall, rise = self._shadows[self._shadow_index]
+        edge = self.edge_time
+        # 0 outside the shadow, 1 fully covered, linear over each edge
+        shade = min(
+            min(max((t - fall) / edge + 0.5, 0.0), 1.0),
+            min(max((rise - t) / edge + 0.5, 0.0), 1.0),
+        )
+        return ambient - (ambient - self.dim_level) * shade
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated racetrack Arduinos on virtual serial ports.")
+    parser.add_argument("--tracks", type=int, default=1, help="number of simulated tracks")
+    parser.add_argument("--rate", type=int, default=4000, help="samples per second")
+    parser.add_argument("--noise", type=float, default=8.0, help="sensor noise, standard deviation")
+    parser.add_argument("--drift", type=float, default=30.0, help="ambient light swing")
+    parser.add_argument("--laps", type=int, default=7, help="laps per race")
+    parser.add_argument("--lap-time", type=float, default=2.0, help="average seconds per lap")
+    parser.add_argument("--pause", type=float, default=10.0, help="seconds between races")
+    parser.add_argument("--ascii", action="store_true", help="simulate old firmware without binary frames")
+    args = parser.parse_args()
+
+    if not hasattr(os, "openpty"):
+        sys.exit("Virtual serial ports need a pty, which Windows doesn't have")
+
+    arduinos, devices = [], []
+    for _ in range(args.tracks):
+        arduino = SimulatedArduino(
+            rate=args.rate,
+            noise=args.noise,
+            drift=args.drift,
+            lap_time=args.lap_time,
+            binary_firmware=not args.ascii,
+        )
+        devices.append(arduino.open_pty())
+        arduino.start()
+        arduinos.append(arduino)
+    print(f"Start the app with RACETRACK_PORTS={','.join(devices)}")
+
+    try:
+        while True:
+            time.sleep(args.pause)
+            races = [arduino.start_race(args.laps) for arduino in arduinos]
+            for track, crossings in enumerate(races, start=1):
+                print(f"Track {track}: race of {crossings[-1] - crossings[0]:.2f} s starting")
+            time.sleep(max(crossings[-1] - crossings[0] for crossings in races) + 1)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""Live race view for a big screen and visitors' phones, served over the booth's network.
+
+GET / serves a small page, GET /events a Server-Sent Events stream of the
+race state: lap counts, elapsed time and today's top times per track. The
+first event holds the whole state, later ones only the tracks that changed.
+Runs on its own thread and event loop, fed by a RaceEngine subscription, so
+sending to clients never holds up the races.
+
+Every tick the server takes the newest engine snapshot, encodes the change
+once and writes the same bytes to every client. A client that can't keep up
+(too much unsent data) gets nothing more until it catches up, and then one
+event with the whole current state instead of everything it missed.
+"""
+
+import asyncio
+import json
+import socket
+import threading
+import time
+
+from leaderboard import today
+
+_PAGE = b"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><meta name="viewport" content="width=device-width">
+<title>Racetrack</title>
+<style>body{font-family:Arial;text-align:center}td{padding:0 1em}</style></head>
+<body><div id="lanes"></div>
+<script>
+const lanes = {}, top = {};
+function render() {
+  let html = "";
+  for (const track of Object.keys(lanes).sort()) {
+    const lane = lanes[track];
+    let text = "waiting for racer";
+    if (lane.phase == "countdown") text = "get ready...";
+    if (lane.phase == "racing") text = `lap ${lane.laps}, ${((performance.now() - lane.since) / 1000 + lane.elapsed).toFixed(1)} s`;
+    if (lane.phase == "finished") text = `finished in ${lane.elapsed.toFixed(2)} s`;
+    html += `<h1>Track ${track}: ${text}</h1><table>`;
+    for (const [name, time] of top[track] || []) html += `<tr><td>${name.replace(/</g, "&lt;")}</td><td>${time.toFixed(2)} s</td></tr>`;
+    html += "</table>";
+  }
+  document.getElementById("lanes").innerHTML = html;
+}
+new EventSource("/events").onmessage = (event) => {
+  const update = JSON.parse(event.data);
+  for (const [track, lane] of Object.entries(update.lanes || {})) lanes[track] = {...lane, since: performance.now()};
+  Object.assign(top, update.top || {});
+};
+setInterval(render, 100);
+</script></body></html>
+"""
+
+_EVENTS_HEADER = (
+    b"HTTP/1.1 200 OK\r\n"
+    b"Content-Type: text/event-stream\r\n"
+    b"Cache-Control: no-cache\r\n"
+    b"Connection: keep-alive\r\n\r\n"
+)
+_KEEPALIVE = b": keepalive\n\n"  # An SSE comment, notices clients that went away
+
+
+def encode_event(update):
+    return b"data: " + json.dumps(update, separators=(",", ":")).encode() + b"\n\n"
+
+
+class SpectatorServer(threading.Thread):
+    """Serves the live race view, see the module docstring."""
+
+    def __init__(
+        self, engine, host="0.0.0.0", port=8080, rate=10, top_count=10, max_backlog=64 * 1024, send_buffer=16 * 1024
+    ):
+        super().__init__(name="spectator-server", daemon=True)
+        self.engine = engine
+        self.host = host
+        self.port = port
+        self.period = 1 / rate
+        self.top_count = top_count
+        self.max_backlog = max_backlog  # Unsent bytes after which a client counts as behind
+        # Kernel send buffer per client. Left to the kernel, it grows to
+        # megabytes for a client that stops reading, long before max_backlog
+        self.send_buffer = send_buffer
+        self.ready = threading.Event()
+
+        self._loop = asyncio.new_event_loop()
+        self._stopping = asyncio.Event()
+        self.subscription = engine.subscribe()
+        self._clients = set()
+        self._behind = set()  # Clients that get the whole state once they've caught up
+        self._lanes = {}  # track -> RaceState last sent
+        self._top = {}  # track -> top times last sent
+
+        self.events = 0
+        self.bytes_sent = 0
+        self.skipped = 0
+        self.max_tick_time = 0.0
+
+    def run(self):
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self._main())
+        finally:
+            self._loop.close()
+
+    def stop(self):
+        if self.is_alive():
+            self._loop.call_soon_threadsafe(self._stopping.set)
+            self.join()
+
+    async def _main(self):
+        server = await asyncio.start_server(self._handle, self.host, self.port, backlog=512)
+        self.port = server.sockets[0].getsockname()[1]
+        print(f"Spectator view on http://{self.host}:{self.port}/")
+        self.ready.set()
+
+        keepalive = 0.0
+        async with server:
+            while not self._stopping.is_set():
+                started = time.monotonic()
+                self._tick()
+                if started - keepalive > 15:
+                    keepalive = started
+                    self._send_all(_KEEPALIVE)
+                self.max_tick_time = max(self.max_tick_time, time.monotonic() - started)
+                await asyncio.sleep(self.period)
+            for writer in self._clients:
+                writer.close()
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 10)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+        path = request.split(b" ", 2)[1] if request.count(b" ") >= 2 else b""
+
+        if path == b"/events":
+            writer.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
+            writer.write(_EVENTS_HEADER)
+            self._clients.add(writer)
+            self._behind.add(writer)  # The whole state on the next tick
+            try:
+                # Nothing more is expected from the client, this only notices it leaving
+                while await reader.read(1024):
+                    pass
+            except ConnectionError:
+                pass
+            finally:
+                self._clients.discard(writer)
+                self._behind.discard(writer)
+        elif path == b"/":
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: text/html; charset=utf-8\r\n"
+                b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(_PAGE) + _PAGE
+            )
+        else:
+            writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+        writer.close()
+
+    def _tick(self):
+        """Sends what changed since the last tick, and the whole state to clients that were behind."""
+        changes = {}
+        snapshot = self.subscription.poll()
+        if snapshot is not None:
+            lanes = {view.track: view.state for view in snapshot.lanes}
+            top = self._standings(lanes)
+            changed_lanes = {track: state for track, state in lanes.items() if self._lanes.get(track) != state}
+            changed_top = {track: times for track, times in top.items() if self._top.get(track) != times}
+            self._lanes, self._top = lanes, top
+            changes = self._update(changed_lanes, changed_top)
+
+        event = encode_event(changes) if changes else None
+        whole_state = None
+        for writer in self._clients:
+            if writer.transport.get_write_buffer_size() > self.max_backlog:
+                self._behind.add(writer)
+                self.skipped += 1
+            elif writer in self._behind:
+                if whole_state is None:
+                    whole_state = encode_event(self._update(self._lanes, self._top))
+                self._write(writer, whole_state)
+                self._behind.discard(writer)
+            elif event is not None:
+                self._write(writer, event)
+
+    def _send_all(self, data):
+        for writer in self._clients:
+            if writer not in self._behind:
+                self._write(writer, data)
+
+    def _write(self, writer, data):
+        writer.write(data)
+        self.events += 1
+        self.bytes_sent += len(data)
+
+    def _standings(self, lanes):
+        leaderboard = self.engine.leaderboard
+        if leaderboard is None:
+            return {}
+        return {track: tuple(leaderboard.top(track, self.top_count, today())) for track in lanes}
+
+    @staticmethod
+    def _update(lanes, top):
+        """The JSON form of an event. Elapsed times are as of now, clients count on from there."""
+        now = time.monotonic()
+        update = {}
+        if lanes:
+            update["lanes"] = {
+                track: {
+                    "phase": state.phase,
+                    "laps": state.lap_count,
+                    "elapsed": round(
+                        state.elapsed_time if state.phase == "finished"
+                        else now - state.started if state.phase == "racing" else 0.0,
+                        2,
+                    ),
+                }
+                for track, state in lanes.items()
+            }
+        if top:
+            update["top"] = {
+                track: [[name, round(elapsed_time, 2)] for name, elapsed_time in times]
+                for track, times in top.items()
+            }
+        return update
+
+    def stats(self):
+        return {
+            "clients": len(self._clients),
+            "behind": len(self._behind),
+            "events": self.events,
+            "bytes_sent": self.bytes_sent,
+            "skipped": self.skipped,
+            "max_tick_ms": 1000 * self.max_tick_time,
+        }
@@ -0,0 +1,218 @@
+"""Recording and replay of raw race sample streams.
+
+Every race's samples are written to a .rtrace file, so disputed lap times can
+be reproduced and detection parameters tuned after the event:
+
+    python traces.py traces/*.rtrace --enter 300 --exit 400 --debounce 0.5
+
+A file is a fixed header followed by blocks, one per batch the race loop
+processed. Each block is a uint32 sample count, then that many float64
+timestamps, then that many float32 values, all little-endian. Keeping the
+columns contiguous lets the reader hand out memoryviews straight into the
+memory-mapped file instead of unpacking records one by one.
+"""
+
+import argparse
+from array import array
+import glob
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+from lap_detector import LapDetector, RaceTimer
+from race_result import format_splits
+from sample_buffer import SampleRingBuffer
+from sensor_protocol import new_sample_arrays
+
+TRACE_MAGIC = b"RTRC"
+TRACE_VERSION = 1
+# magic, version, track, created (unix time), enter threshold, exit threshold
+TRACE_HEADER = struct.Struct("<4sHHddd")
+_BLOCK_HEADER = struct.Struct("<I")
+
+
+class TraceWriter:
+    def __init__(self, path, track, enter_threshold, exit_threshold):
+        self.path = path
+        self.samples = 0
+        self._file = open(path, "wb")
+        self._file.write(
+            TRACE_HEADER.pack(
+                TRACE_MAGIC, TRACE_VERSION, track, time.time(), enter_threshold, exit_threshold
+            )
+        )
+
+    @classmethod
+    def for_race(cls, directory, track, calibration):
+        """A new trace file for a race on this track, named after the current time."""
+        os.makedirs(directory, exist_ok=True)
+        filename = time.strftime(f"%Y%m%d-%H%M%S-track{track}.rtrace", time.localtime())
+        return cls(
+            os.path.join(directory, filename),
+            track,
+            calibration.enter_threshold,
+            calibration.exit_threshold,
+        )
+
+    def write(self, times, values):
+        count = len(values)
+        if count == 0:
+            return
+        times, values = array("d", times), array("f", values)
+        if sys.byteorder == "big":
+            times.byteswap()
+            values.byteswap()
+        self._file.write(_BLOCK_HEADER.pack(count))
+        self._file.write(times)
+        self._file.write(values)
+        self.samples += count
+
+    def close(self):
+        self._file.close()
+
+
+class TraceReader:
+    """Reads a trace through mmap, so even long traces are never loaded fully."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.track, self.created, self.enter_threshold, self.exit_threshold = (
+            TRACE_HEADER.unpack_from(self._map, 0)
+        )
+        if magic != TRACE_MAGIC or version != TRACE_VERSION:
+            self.close()
+            raise ValueError(f"{path} is not a version {TRACE_VERSION} race trace")
+
+    def blocks(self):
+        """Yields (times, values) memoryviews into the file, one pair per recorded batch.
+
+        The views are only valid until the reader is closed. They use the
+        host's byte order, which is little-endian on every booth laptop.
+        """
+        view = memoryview(self._map)
+        position, end = TRACE_HEADER.size, len(self._map)
+        while position + _BLOCK_HEADER.size <= end:
+            (count,) = _BLOCK_HEADER.unpack_from(self._map, position)
+            position += _BLOCK_HEADER.size
+            values_start = position + 8 * count
+            block_end = values_start + 4 * count
+            if block_end > end:
+                break  # Cut off, e.g. the app was killed mid-race
+            yield view[position:values_start].cast("d"), view[values_start:block_end].cast("f")
+            position = block_end
+
+    def close(self):
+        try:
+            self._map.close()
+        except BufferError:
+            pass  # Views from blocks() still alive, the GC closes the map later
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ReplaySource(threading.Thread):
+    """Feeds a recorded trace into a SampleRingBuffer, in place of an AcquisitionThread.
+
+    With realtime=True samples arrive as fast as they were recorded, otherwise
+    as fast as the consumer keeps up; the buffer is never overrun either way.
+    """
+
+    def __init__(self, path, buffer, realtime=True):
+        super().__init__(name="trace-replay", daemon=True)
+        self.path = path
+        self.buffer = buffer
+        self.realtime = realtime
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            self._replay()
+        finally:
+            self.done.set()
+
+    def _replay(self):
+        with TraceReader(self.path) as reader:
+            first_sample, started = None, time.monotonic()
+            for times, values in reader.blocks():
+                if self.realtime and len(times):
+                    if first_sample is None:
+                        first_sample = times[0]
+                    delay = started + (times[0] - first_sample) - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                # The ring buffer stores float64 arrays, convert the block once
+                block_times, block_values = array("d"), array("d", values)
+                block_times.frombytes(times.cast("B"))
+                del times, values  # Don't keep views into the map alive
+
+                written = 0
+                while written < len(block_values):
+                    space = self.buffer.capacity - len(self.buffer)
+                    if space == 0:
+                        time.sleep(0.001)
+                        continue
+                    written += self.buffer.write(
+                        block_times[written : written + space],
+                        block_values[written : written + space],
+                    )
+
+
+def replay_race(path, enter_threshold=None, exit_threshold=None, debounce_time=0.5, number_laps=7, realtime=False):
+    """Times a recorded race again through the same buffer and race timer as a live race.
+
+    Thresholds default to the ones used when the race was recorded.
+    """
+    with TraceReader(path) as reader:
+        enter_threshold = reader.enter_threshold if enter_threshold is None else enter_threshold
+        exit_threshold = reader.exit_threshold if exit_threshold is None else exit_threshold
+
+    buffer = SampleRingBuffer()
+    source = ReplaySource(path, buffer, realtime=realtime)
+    timer = RaceTimer(LapDetector(enter_threshold, exit_threshold, debounce_time), number_laps)
+    times, values = new_sample_arrays()
+
+    source.start()
+    while not (source.done.is_set() and len(buffer) == 0):
+        del times[:], values[:]
+        if buffer.read(times, values):
+            timer.process(times, values)
+        else:
+            time.sleep(0.001)
+    return timer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-time recorded races with other detection parameters.")
+    parser.add_argument("traces", nargs="+", help=".rtrace files or glob patterns")
+    parser.add_argument("--enter", type=float, help="enter (shadow) threshold, default: as recorded")
+    parser.add_argument("--exit", type=float, help="exit (light) threshold, default: as recorded")
+    parser.add_argument("--debounce", type=float, default=0.5, help="minimum seconds between laps")
+    parser.add_argument("--laps", type=int, default=7, help="laps per race")
+    parser.add_argument("--realtime", action="store_true", help="replay at recorded speed")
+    args = parser.parse_args()
+
+    # Windows shells don't expand globs, so do it here
+    paths = sorted({path for pattern in args.traces for path in glob.glob(pattern) or [pattern]})
+    start = time.perf_counter()
+    for path in paths:
+        timer = replay_race(path, args.enter, args.exit, args.debounce, args.laps, args.realtime)
+        if timer.finished:
+            result = f"{timer.elapsed_time:.2f} s, laps {format_splits(timer.result.splits)}"
+        else:
+            result = f"not finished, {timer.lap_count} crossings"
+        print(f"{os.path.basename(path)}: {result}")
+    print(f"Replayed {len(paths)} races in {time.perf_counter() - start:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+"""Background upload of race results to the Google Sheets leaderboard.
+
+Results first go into an on-disk outbox (SQLite in WAL mode), so nothing is
+lost when the booth Wi-Fi drops or the app is closed. A background thread
+sends pending rows in batches over one pooled HTTP session and retries with
+exponential backoff. A row the sheet refuses is parked in the outbox instead
+of holding up the ones behind it.
+
+Batched calls send "values" as a list of rows, each with a "Key" column
+holding its idempotency key, so the Apps Script can skip rows it already
+added when a retry follows a response that got lost. The key is a hash of
+the row's content, so the same result queued on two laptops (e.g. merged
+with upload-to-gsheets.py after an event) only ends up in the sheet once.
+
+The script answers with JSON: {"result": "success"} once the rows are in the
+sheet, {"result": "error", ...} when it refuses them. Apps Script can't set
+a status code, so a refusal comes with HTTP 200 too. Any other answer, e.g.
+a Google error page, counts as a failure to retry, never as a refusal.
+"""
+
+import hashlib
+import json
+import random
+import sqlite3
+import threading
+import time
+
+from metrics import METRICS
+from race_result import format_splits
+
+GSHEET_URL = "https://script.google.com/macros/s/AKfycbyUeNjw-wHF3ODJ8TyBLEv41bUDjciQFqEs-wXTWizN1E8xFT3KzA9a11YNHTarRBxUPw/exec"
+
+
+def format_time(elapsed_time):
+    """Formats seconds the way the leaderboard sheet expects: mm:ss:hh."""
+    # Truncated to hundredths, but 0.29 * 100 is 28.999999999999996 in floats
+    total_hundredths = int(round(elapsed_time * 100, 6))
+    minutes, hundredths = divmod(total_hundredths, 6000)
+    seconds, hundredths = divmod(hundredths, 100)
+    return f"{minutes:02}:{seconds:02}:{hundredths:02}"
+
+
+def make_row(name, email, track, elapsed_time, timestamp=None, splits=None):
+    if timestamp is None:
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+    row = {
+        "Timestamp": timestamp,
+        "Name": name,
+        "E-mail": email,
+        "Track": track,
+        "Time": format_time(elapsed_time),
+    }
+    # Only with lap times, so rows without them keep the key they always had
+    if splits:
+        row["Laps"] = format_splits(splits)
+    return row
+
+
+def row_key(row):
+    """Idempotency key of a row: a hash of its content, "Key" column excluded."""
+    content = {column: value for column, value in row.items() if column != "Key"}
+    encoded = json.dumps(content, sort_keys=True, separators=(",", ":")).encode()
+    return hashlib.sha256(encoded).hexdigest()[:32]
+
+
+def post_rows(session, rows, url=GSHEET_URL, sheet="Track", timeout=10):
+    """Adds rows (each with its "Key") to the sheet in one request, raises on failure."""
+    import requests  # Already loaded by new_session()
+
+    payload = {"sheet": sheet, "action": "add", "values": rows}
+    response = session.post(url, json=payload, timeout=timeout)
+    response.raise_for_status()
+    # The outcome is in the body, see the module docstring
+    try:
+        result = response.json().get("result")
+    except (ValueError, AttributeError):
+        result = None
+    if result == "error":
+        raise requests.HTTPError(f"Sheet refused the rows: {response.text[:200]}", response=response)
+    if result != "success":
+        # No response attached, so is_rejection() takes it for a failure to retry
+        raise requests.RequestException(f"Unexpected answer from the sheet: {response.text[:200]}")
+
+
+def is_rejection(error):
+    """Whether the sheet refused a request for what's in it, rather than failing to take it."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return False
+    status = response.status_code
+    return status < 300 or (400 <= status < 500 and status not in (408, 429))
+
+
+def new_session():
+    # requests takes a few hundred ms to import, so only once it's needed
+    import requests
+
+    session = requests.Session()
+    session.headers["Content-Type"] = "application/json"
+    return session
+
+
+class Outbox:
+    """Append-only queue of rows waiting to be uploaded, deduplicated by key."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS outbox (
+                key TEXT PRIMARY KEY,
+                row TEXT NOT NULL,
+                created REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                sent REAL,
+                parked REAL
+            )"""
+        )
+        # Outboxes created before rows were parked
+        columns = [column[1] for column in self._db.execute("PRAGMA table_info(outbox)")]
+        if "parked" not in columns:
+            self._db.execute("ALTER TABLE outbox ADD COLUMN parked REAL")
+            self._db.execute("DROP INDEX IF EXISTS outbox_pending")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (attempts, created)"
+            " WHERE sent IS NULL AND parked IS NULL"
+        )
+
+    def add(self, key, row):
+        """Returns False if a row with this key was queued before."""
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO outbox (key, row, created) VALUES (?, ?, ?)",
+                (key, json.dumps(row), time.time()),
+            )
+        return cursor.rowcount == 1
+
+    def add_many(self, keyed_rows):
+        """Queues (key, row) pairs in one transaction, returns how many were new."""
+        created = time.time()
+        with self._lock:
+            before = self._db.total_changes
+            with self._db:
+                self._db.execute("BEGIN")
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO outbox (key, row, created) VALUES (?, ?, ?)",
+                    ((key, json.dumps(row), created) for key, row in keyed_rows),
+                )
+            return self._db.total_changes - before
+
+    def add_unsent(self, keyed_rows, retry_before=0.0):
+        """Queues (key, row) pairs in one transaction, returns the ones to send now.
+
+        Those are the new rows, plus rows queued before `retry_before` (a
+        time.time()) that were never sent. Rows sent before, and repeats of
+        rows queued since, are skipped.
+        """
+        keyed_rows = dict(keyed_rows)  # Repeats within the batch count once
+        created = time.time()
+        with self._lock:
+            with self._db:
+                self._db.execute("BEGIN")
+                queued = self._db.execute(
+                    f"SELECT key, created, sent FROM outbox WHERE key IN ({','.join('?' * len(keyed_rows))})",
+                    list(keyed_rows),
+                ).fetchall()
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO outbox (key, row, created) VALUES (?, ?, ?)",
+                    ((key, json.dumps(row), created) for key, row in keyed_rows.items()),
+                )
+        for key, queued_at, sent in queued:
+            if sent is not None or queued_at >= retry_before:
+                del keyed_rows[key]
+        return list(keyed_rows.items())
+
+    def rows(self, chunk_size=1000):
+        """Yields every row ever queued, sent or not, in the order they were queued."""
+        last = 0
+        while True:
+            with self._lock:
+                chunk = self._db.execute(
+                    "SELECT rowid, row FROM outbox WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                    (last, chunk_size),
+                ).fetchall()
+            if not chunk:
+                return
+            for last, row in chunk:
+                yield json.loads(row)
+
+    def pending(self, limit):
+        """Rows to send next, oldest first, but rows that failed before after the others."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT key, row FROM outbox WHERE sent IS NULL AND parked IS NULL"
+                " ORDER BY attempts, created LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [(key, json.loads(row)) for key, row in rows]
+
+    def pending_count(self):
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM outbox WHERE sent IS NULL AND parked IS NULL"
+            ).fetchone()[0]
+
+    def parked_count(self):
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM outbox WHERE sent IS NULL AND parked IS NOT NULL"
+            ).fetchone()[0]
+
+    def mark_sent(self, keys):
+        self._update("UPDATE outbox SET sent = ? WHERE key = ?", ((time.time(), key) for key in keys))
+
+    def mark_failed(self, keys):
+        self._update("UPDATE outbox SET attempts = attempts + 1 WHERE key = ?", ((key,) for key in keys))
+
+    def park(self, keys):
+        """Stops retrying rows the sheet refused. They stay in the outbox, e.g. for bulk_upload.py."""
+        self._update("UPDATE outbox SET parked = ? WHERE key = ?", ((time.time(), key) for key in keys))
+
+    def _update(self, statement, parameters):
+        with self._lock, self._db:
+            self._db.execute("BEGIN")
+            self._db.executemany(statement, parameters)
+
+
+class Uploader(threading.Thread):
+    """Sends rows from the outbox to the leaderboard without blocking the caller."""
+
+    def __init__(
+        self,
+        outbox,
+        url=GSHEET_URL,
+        sheet="Track",
+        batch_size=50,
+        timeout=10,
+        min_backoff=1.0,
+        max_backoff=300.0,
+    ):
+        super().__init__(name="leaderboard-uploader", daemon=True)
+        self.outbox = outbox
+        self.url = url
+        self.sheet = sheet
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+        self.session = None  # Created by the upload thread, see run()
+        self.failures = 0
+        self.sent = 0
+        self.parked = 0
+
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+
+    def submit(self, row, key=None):
+        """Queues a row for upload and returns its idempotency key."""
+        key = key or row_key(row)
+        self.outbox.add(key, row)
+        self._wake.set()
+        return key
+
+    def run(self):
+        self.session = new_session()
+        import requests  # For the exception type, new_session() already loaded it
+        upload_latency = METRICS.histogram("upload")
+        limit = self.batch_size
+        while not self._stopping.is_set():
+            batch = self.outbox.pending(limit)
+            if not batch:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+
+            keys = [key for key, _ in batch]
+            started = time.monotonic()
+            try:
+                self._post([dict(row, Key=key) for key, row in batch])
+            except requests.RequestException as error:
+                if not is_rejection(error):
+                    # Offline or a server error: retried, however long it takes
+                    self.outbox.mark_failed(keys)
+                elif len(keys) > 1:
+                    # One bad row refuses the whole batch. Halve the batches until
+                    # it's on its own, without counting it against the others
+                    limit = max(1, len(keys) // 2)
+                else:
+                    print(f"Giving up on a result the sheet refused ({error}), kept in the outbox")
+                    self.outbox.park(keys)
+                    self.parked += 1
+                self.failures += 1
+                # Exponential backoff with full jitter, so several booth
+                # laptops coming back online don't retry in lockstep
+                backoff = min(self.max_backoff, self.min_backoff * 2 ** (self.failures - 1))
+                delay = random.uniform(0, backoff)
+                print(f"Upload of {len(keys)} results failed ({error}), retrying in {delay:.1f} s")
+                self._stopping.wait(delay)
+            else:
+                upload_latency.record(time.monotonic() - started)
+                self.outbox.mark_sent(keys)
+                self.failures = 0
+                self.sent += len(keys)
+                limit = min(self.batch_size, limit * 2)
+
+    def _post(self, rows):
+        post_rows(self.session, rows, self.url, self.sheet, self.timeout)
+
+    def flush(self, timeout=None):
+        """Waits until nothing in the outbox is left to send, returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self._wake.set()
+        while self.outbox.pending_count():
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()